@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the scaling of the sync hot path, without touching the network or NetworkManager.
+
+Synthetic /server catalogs are generated for each size, and probes are answered by a local fake backend
+with configurable latency and loss distributions. Each stage runs in its own process, so peak RSS,
+process count and probes sent are measured for that stage alone.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_sync.py --sizes 500,5000,50000
+    python3 benchmarks/bench_sync.py --backend ping --sizes 500 --stages get_best_servers
+"""
+
+import argparse
+import asyncio
+import configparser
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from nordnm import benchmarking  # noqa: E402
+from nordnm import networkmanager  # noqa: E402
+from nordnm import nordapi  # noqa: E402
+from nordnm import nordnm  # noqa: E402
+from nordnm import paths  # noqa: E402
+from nordnm.servercatalog import ServerCatalog  # noqa: E402
+from nordnm.settings import SettingsHandler  # noqa: E402
+
+STAGES = ['get_valid_servers', 'get_best_servers', 'sync_servers']
+DEFAULT_SIZES = '500,2000,10000,50000'
+
+NUM_COUNTRIES = 60
+CATEGORY_FREQUENCIES = [  # Roughly the make-up of the real catalog
+    ('Standard VPN servers', 0.95),
+    ('P2P', 0.6),
+    ('Double VPN', 0.03),
+    ('Dedicated IP', 0.02),
+    ('Onion Over VPN', 0.01),
+    ('Anti DDoS', 0.01),
+]
+
+FAKE_PING = r'''#!/bin/sh
+# Stand-in for ping, answering 'ping -c COUNT -n -i INTERVAL -W TIMEOUT HOST' from the benchmark's latency model
+echo >> "{counter}"
+exec awk -v host="$8" -v count="$2" -v interval="$5" -v scale="{time_scale}" -v mean="{latency_mean}" -v sigma="{latency_sigma}" -v loss="{loss}" -v dead="{dead}" '
+function hash(s,    i, h) {{ h = 0; for (i = 1; i <= length(s); i++) h = (h * 31 + index("0123456789.", substr(s, i, 1))) % 2147483647; return h }}
+BEGIN {{
+    srand(hash(host));
+    base = mean * exp(sigma * sqrt(-2 * log(rand())) * cos(6.2831853 * rand()) - sigma * sigma / 2);
+    alive = rand() >= dead;
+    srand();
+    received = 0; total = 0; max = 0;
+    for (i = 0; i < count; i++) {{
+        if (alive && rand() >= loss) {{ rtt = base * (0.9 + rand() * 0.2); received++; total += rtt; if (rtt > max) max = rtt }}
+    }}
+    system("sleep " ((count - 1) * interval + (received ? max / 1000 : 1)) * scale);
+    print "PING " host;
+    printf "%d packets transmitted, %d received, %d%% packet loss, time 0ms\n", count, received, (count - received) * 100 / count;
+    if (received) printf "rtt min/avg/max/mdev = %.3f/%.3f/%.3f/%.3f ms\n", base, total / received, max, base * 0.05;
+    exit(received ? 0 : 1)
+}}'
+'''
+
+
+class LatencyModel(object):
+    # Each host gets a stable, log-normally distributed base latency. Individual probes vary around it and are lost at random
+    def __init__(self, latency_mean, latency_sigma, loss, dead):
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.loss = loss
+        self.dead = dead
+        self.hosts = {}
+
+    def get_host(self, host):
+        if host not in self.hosts:
+            host_random = random.Random(hashlib.md5(host.encode()).digest())
+            base_rtt = host_random.lognormvariate(0, self.latency_sigma) * self.latency_mean / 1000
+            self.hosts[host] = (base_rtt, host_random.random() < self.dead)
+
+        return self.hosts[host]
+
+    def sample(self, host):
+        # Returns an RTT in seconds, or None if the probe was lost
+        base_rtt, dead = self.get_host(host)
+        if dead or random.random() < self.loss:
+            return None
+
+        return base_rtt * random.uniform(0.9, 1.1)
+
+
+class FakeProber(benchmarking.IcmpProber):
+    """
+    Answers echo requests from a LatencyModel instead of the network. Pacing, timeouts and result
+    aggregation are inherited, so the benchmark exercises the same scheduling as the real engine.
+    """
+
+    def __init__(self, loop, budget, model, time_scale):
+        super().__init__(None, False, loop, budget._replace(rate=budget.rate / time_scale))
+        self.model = model
+        self.time_scale = time_scale
+        self.sent = 0
+
+    async def send_echo(self, host):
+        await self.bucket.acquire()
+        self.sent += 1
+
+        future = self.loop.create_future()
+        rtt = self.model.sample(host)
+
+        if rtt is None or rtt > benchmarking.PROBE_TIMEOUT:
+            self.loop.call_later(benchmarking.PROBE_TIMEOUT * self.time_scale, self.answer, future, None)
+        else:
+            self.loop.call_later(rtt * self.time_scale, self.answer, future, rtt)
+
+        future.add_done_callback(self.record_outcome)
+        return future
+
+    def answer(self, future, rtt):
+        # The probe may have been cancelled in the meantime, if benchmarking was stopped early
+        if not future.done():
+            future.set_result(rtt)
+
+
+class Stats(object):
+    probes = 0
+
+
+def make_catalog(num_servers, seed=0):
+    # A synthetic /server response, shaped like the real one (including the fields nordnm never reads)
+    catalog_random = random.Random(seed)
+    countries = [('Country %i' % i, chr(65 + i // 26) + chr(65 + i % 26)) for i in range(NUM_COUNTRIES)]
+
+    servers = []
+    for i in range(num_servers):
+        country, flag = catalog_random.choice(countries)
+        categories = [{'name': name} for name, frequency in CATEGORY_FREQUENCIES if catalog_random.random() < frequency]
+        if not categories:
+            categories = [{'name': CATEGORY_FREQUENCIES[0][0]}]
+
+        servers.append({
+            'id': i,
+            'ip_address': '10.%i.%i.%i' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            'search_keywords': [],
+            'categories': categories,
+            'name': '%s #%i' % (country, i),
+            'domain': '%s%i.nordvpn.com' % (flag.lower(), i),
+            'price': 0,
+            'flag': flag,
+            'country': country,
+            'location': {'lat': catalog_random.uniform(-90, 90), 'long': catalog_random.uniform(-180, 180)},
+            'load': catalog_random.randint(0, 100),
+            'features': {
+                'ikev2': True,
+                'openvpn_udp': catalog_random.random() < 0.97,
+                'openvpn_tcp': catalog_random.random() < 0.97,
+                'socks': False,
+                'proxy': False,
+                'pptp': False,
+                'l2tp': False,
+                'openvpn_xor_udp': False,
+                'openvpn_xor_tcp': False,
+                'proxy_cybersec': False,
+                'proxy_ssl': False,
+                'proxy_ssl_cybersec': False,
+                'ikev2_v6': False,
+                'openvpn_udp_v6': False,
+                'openvpn_tcp_v6': False,
+                'wireguard_udp': False,
+                'openvpn_udp_tls_crypt': False,
+                'openvpn_tcp_tls_crypt': False,
+                'openvpn_dedicated_udp': False,
+                'openvpn_dedicated_tcp': False,
+                'skylark': False,
+            },
+        })
+
+    return json.dumps(servers)
+
+
+def write_settings(path):
+    settings = configparser.ConfigParser(allow_no_value=True, interpolation=None)
+    settings['Countries'] = {'country-blacklist': '', 'country-whitelist': ''}
+    settings['Categories'] = {category.replace(' ', '-').lower(): 'true' for category in nordapi.VPN_CATEGORIES}
+    settings['Protocols'] = {'tcp': 'true', 'udp': 'true'}
+    settings['DNS'] = {'custom-dns-servers': ''}
+    settings['Benchmarking'] = {'ping-attempts': str(SettingsHandler.DEFAULT_PING_ATTEMPTS), 'cache-ttl': '0'}
+
+    with open(path, 'w') as settings_file:
+        settings.write(settings_file)
+
+
+class FakeCredentials(object):
+    def get_username(self):
+        return 'user@example.com'
+
+    def get_password(self):
+        return 'password'
+
+
+def make_nordnm(root):
+    # Build an instance without running the CLI in __init__
+    instance = nordnm.NordNM.__new__(nordnm.NordNM)
+    instance.logger = logging.getLogger(nordnm.__name__)
+    instance.active_servers = {}
+    instance.changed_config_domains = set()
+    instance.state_store = None
+    instance.server_filter = None
+    instance.server_cache = None
+    instance.probe_cache = None
+    instance.settings = SettingsHandler(paths.SETTINGS)
+    instance.credentials = FakeCredentials()
+    instance.black_list = instance.settings.get_blacklist()
+    instance.white_list = instance.settings.get_whitelist()
+    instance.configs_exist = lambda: True
+    instance.get_ovpn_path = lambda domain, protocol: os.path.join(root, domain + '.' + protocol + '.ovpn')
+
+    return instance
+
+
+def install_fakes(args, root):
+    # Redirect local data into the temporary root, and replace everything that would touch the system
+    paths.ROOT = root
+    paths.SETTINGS = os.path.join(root, 'settings.conf')
+    paths.ACTIVE_SERVERS = os.path.join(root, '.active_servers')
+    paths.STATE = os.path.join(root, '.state.db')
+    paths.PROBE_CACHE = os.path.join(root, '.probe_cache')
+    paths.SERVER_CACHE = os.path.join(root, '.server_cache')
+    write_settings(paths.SETTINGS)
+
+    networkmanager.remove_killswitch = lambda log=True: False
+    networkmanager.remove_autoconnect = lambda: False
+    networkmanager.get_autoconnect = lambda: (None, None)
+    networkmanager.disconnect_active_vpn = lambda active_servers: False
+    networkmanager.get_connections = lambda: {}
+    networkmanager.get_vpn_connections = lambda: []
+    networkmanager.remove_connection = lambda connection_name: True
+    networkmanager.import_connection = lambda *args, **kwargs: True
+
+    model = LatencyModel(args.latency_mean, args.latency_sigma, args.loss, args.dead)
+    benchmarking.PROBE_INTERVAL *= args.time_scale
+
+    if args.backend == 'probe':
+        def fake_iter_icmp_results(icmp_socket, hosts, ping_attempts, budget=benchmarking.DEFAULT_BUDGET, deadline=None):
+            loop = asyncio.new_event_loop()
+            prober = FakeProber(loop, budget, model, args.time_scale)
+            try:
+                yield from prober.iter_results(hosts, ping_attempts, deadline)
+            finally:
+                Stats.probes += prober.sent
+                loop.close()
+
+        benchmarking.open_icmp_socket = lambda: (None, False)
+        benchmarking.iter_icmp_results = fake_iter_icmp_results
+    else:
+        # Force the 'ping' process fallback, with a fake ping first on the PATH
+        bin_path = os.path.join(root, 'bin')
+        os.mkdir(bin_path)
+        ping_path = os.path.join(bin_path, 'ping')
+        with open(ping_path, 'w') as ping_file:
+            ping_file.write(FAKE_PING.format(counter=os.path.join(root, 'ping_calls'), time_scale=args.time_scale, latency_mean=args.latency_mean,
+                                             latency_sigma=args.latency_sigma, loss=args.loss, dead=args.dead))
+        os.chmod(ping_path, os.stat(ping_path).st_mode | stat.S_IEXEC)
+        os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+
+        iter_ping_results = benchmarking.iter_ping_results
+
+        def counted_iter_ping_results(hosts, ping_attempts, budget=benchmarking.DEFAULT_BUDGET, deadline=None):
+            for result in iter_ping_results(hosts, ping_attempts, budget, deadline):
+                Stats.probes += ping_attempts
+                yield result
+
+        benchmarking.open_icmp_socket = lambda: None
+        benchmarking.iter_ping_results = counted_iter_ping_results
+
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM, so the peak only covers what runs afterwards
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    # In MiB
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+    return None
+
+
+def run_stage(stage, num_servers, args, connection):
+    root = tempfile.mkdtemp(prefix='nordnm-bench-')
+
+    # Benchmark progress and warnings would only garble the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stderr.fileno())
+    os.dup2(devnull, sys.stdout.fileno())
+
+    try:
+        install_fakes(args, root)
+        instance = make_nordnm(root)
+
+        catalog_data = make_catalog(num_servers, args.seed).encode('utf-8')
+
+        def get_catalog_chunks():
+            for i in range(0, len(catalog_data), nordapi.CHUNK_SIZE):
+                yield catalog_data[i:i + nordapi.CHUNK_SIZE]
+
+        catalog = ServerCatalog(nordapi.sort_server_list(list(nordapi.iter_servers(get_catalog_chunks())), sort_by_load=True))
+        nordapi.get_server_data = lambda etag=None, last_modified=None: (get_catalog_chunks(), None, None)
+
+        if stage == 'get_valid_servers':
+            def run():
+                return instance.get_valid_servers(catalog)
+        elif stage == 'get_best_servers':
+            valid_servers = instance.get_valid_servers(catalog)
+
+            def run():
+                budget = benchmarking.ProbeBudget(instance.settings.get_probe_rate(), instance.settings.get_probe_burst(), instance.settings.get_loss_threshold())
+                return benchmarking.get_best_servers(valid_servers, args.attempts, instance.settings.get_protocols(), instance.settings.get_categories(), budget,
+                                                     refine_candidates=instance.settings.get_refine_candidates(), weights=instance.settings.get_score_weights())
+        else:
+            def run():
+                return instance.sync_servers(preserve_vpn=False, slow_mode=False)
+
+        # Sample the number of live child processes while the stage runs
+        peak_children = [0]
+        running = threading.Event()
+        running.set()
+
+        def count_children():
+            while running.is_set():
+                peak_children[0] = max(peak_children[0], len(multiprocessing.active_children()))
+                time.sleep(0.01)
+
+        sampler = threading.Thread(target=count_children, daemon=True)
+        reset_peak_rss()
+        sampler.start()
+
+        start = time.perf_counter()
+        run()
+        wall_time = time.perf_counter() - start
+
+        running.clear()
+        sampler.join()
+
+        ping_calls = 0
+        counter_path = os.path.join(root, 'ping_calls')
+        if os.path.isfile(counter_path):
+            with open(counter_path) as counter:
+                ping_calls = len(counter.readlines())
+
+        connection.send({
+            'wall_time': wall_time,
+            'peak_rss': get_peak_rss(),
+            'processes': 1 + peak_children[0] + ping_calls,
+            'probes': Stats.probes,
+        })
+    except BaseException as ex:
+        connection.send({'error': repr(ex)})
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the nordnm sync hot path against synthetic server catalogs.")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Comma separated catalog sizes to benchmark. (Default: %s)" % DEFAULT_SIZES)
+    parser.add_argument('--stages', default=','.join(STAGES), help="Comma separated stages to benchmark, from: %s" % ', '.join(STAGES))
+    parser.add_argument('--backend', choices=['probe', 'ping'], default='probe', help="Fake the asyncio ICMP engine (probe) or the 'ping' process pool (ping).")
+    parser.add_argument('--attempts', type=int, default=SettingsHandler.DEFAULT_PING_ATTEMPTS, help="Ping attempts per server.")
+    parser.add_argument('--latency-mean', type=float, default=80.0, help="Mean server latency, in milliseconds.")
+    parser.add_argument('--latency-sigma', type=float, default=0.6, help="Spread (log-normal sigma) of server latencies.")
+    parser.add_argument('--loss', type=float, default=0.01, help="Probability of any single probe being lost.")
+    parser.add_argument('--dead', type=float, default=0.02, help="Probability of a server never answering.")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Scale simulated delays and probe pacing, e.g. 0.1 runs ten times faster.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic catalogs.")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("Unknown stage '%s'" % stage)
+
+    format_string = "| %-17s | %-7s | %-10s | %-14s | %-9s | %-8s |"
+    print(format_string % ("STAGE", "SERVERS", "WALL (s)", "PEAK RSS (MiB)", "PROCESSES", "PROBES"))
+    print("|-------------------+---------+------------+----------------+-----------+----------|")
+
+    context = multiprocessing.get_context('fork')
+    for num_servers in sizes:
+        for stage in stages:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_stage, args=(stage, num_servers, args, sender))
+            process.start()
+            sender.close()
+
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {'error': "exited with code %s" % process.exitcode}
+            process.join()
+
+            if 'error' in result:
+                print(format_string % (stage, num_servers, 'failed', result['error'], '', ''))
+            else:
+                print(format_string % (stage, num_servers, '%.3f' % result['wall_time'], '%.1f' % result['peak_rss'], result['processes'], result['probes']))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
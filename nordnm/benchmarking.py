@@ -1,68 +1,317 @@
-from nordnm import nordnm
 from nordnm import utils
-from nordnm import nordapi
+from nordnm import scoring
 
+import asyncio
+import collections
+import logging
+import math
 import multiprocessing
 from functools import partial
 import numpy
 import os
 import sys
+import socket
+import struct
 import subprocess
-from decimal import Decimal
 import resource
+import signal
+from timeit import default_timer as timer
 
-EXP_SENSITIVITY = 50  # Controls the gradient of the exponential score function. The higher the number, the smaller the gradient (change)
 MAX_FD = 512
+MAX_LOAD = 95  # Servers at or above this load are never probed
 
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_PAYLOAD = b'nordnm-benchmark'
+PROBE_INTERVAL = 0.2  # Seconds between echo requests to the same host (same as 'ping -i 0.2')
+PROBE_TIMEOUT = 1  # Seconds to wait for each echo reply (same as 'ping -W 1')
+SLOW_PROBE_RATE = 200  # Slow mode caps the probe rate at this many echo requests per second
+MIN_PROBE_RATE = 20  # Backing off never slows probing below this many echo requests per second,
+MIN_PROBE_RATE_FRACTION = 0.1  # or below this fraction of the budget, in case the losses aren't caused by the rate at all
+LOSS_WINDOW = 200  # Number of echo requests the observed loss is measured over, before adjusting the rate
 
-def get_server_score(server, ping_attempts):
-    load = server['load']
-    ip_addr = server['ip_address']
+# How fast benchmarking may probe: echo requests per second, how many may be sent at once, and the loss (%) that triggers a back-off
+ProbeBudget = collections.namedtuple('ProbeBudget', ['rate', 'burst', 'loss_threshold'])
+DEFAULT_BUDGET = ProbeBudget(2000, 100, 10.0)
 
-    score = 0  # Lowest starting score
-    rtt = None
+logger = logging.getLogger(__name__)
 
-    # If a server is at 95% load or greater, we don't need to waste time pinging. Just keep starting score.
-    if load < 95:
-        rtt, loss = utils.get_rtt_loss(ip_addr, ping_attempts)
 
-        if loss < 5:  # Similarly, if packet loss is >= 5%, the connection is not reliable. Keep the starting score.
-            score = round(Decimal(1 / (numpy.exp(((load/100) * rtt) / EXP_SENSITIVITY))), 4)  # Maximise the score for smaller values of ln(load + rtt)
+def get_icmp_checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
 
-    return (score, load, rtt)
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
 
+    return ~total & 0xffff
 
-def compare_server(server, best_servers, ping_attempts, valid_protocols, valid_categories):
-    supported_protocols = []
-    if server['features']['openvpn_udp'] and 'udp' in valid_protocols:
-        supported_protocols.append('udp')
-    if server['features']['openvpn_tcp'] and 'tcp' in valid_protocols:
-        supported_protocols.append('tcp')
 
-    country_code = server['flag'].lower()
-    domain = server['domain']
-    score, load, latency = get_server_score(server, ping_attempts)
+def build_echo_request(identifier, sequence):
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    checksum = get_icmp_checksum(header + ICMP_PAYLOAD)
 
-    # The ping benchmark failed, so return fail
-    if not latency:
-        return False
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, identifier, sequence) + ICMP_PAYLOAD
 
-    for category in server['categories']:
-        category_long_name = category['name']
-        if category_long_name in valid_categories:
-            category_short_name = nordapi.VPN_CATEGORIES[category['name']]
 
-            for protocol in supported_protocols:
-                best_score = -1
+def open_icmp_socket():
+    # Unprivileged ICMP datagram sockets are preferred, but depend on net.ipv4.ping_group_range including our group
+    try:
+        return (socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False)
+    except OSError:
+        pass
 
-                if best_servers.get((country_code, category_short_name, protocol)):
-                    best_score = best_servers[country_code, category_short_name, protocol]['score']
+    if os.getuid() != 0:
+        return None
 
-                if score > best_score:
-                    name = nordnm.generate_connection_name(server, protocol)
-                    best_servers[country_code, category_short_name, protocol] = {'name': name, 'domain': domain, 'score': score, 'load': load, 'latency': latency}
+    def open_raw_socket():
+        try:
+            return (socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True)
+        except OSError as ex:
+            logger.debug("Could not open a raw ICMP socket: %s", ex)
+            return None
+
+    # Raw sockets require root privilege
+    if os.geteuid() == 0:
+        return open_raw_socket()
+    else:
+        return utils.run_as_root(open_raw_socket)
+
+
+def get_slow_budget(budget):
+    return budget._replace(rate=min(budget.rate, SLOW_PROBE_RATE), burst=1)
+
+
+class TokenBucket(object):
+    """
+    Releases waiters at a steady rate, allowing up to 'burst' at once after an idle period.
+    Waiters are released in FIFO order by a single timer, so rate changes take effect immediately.
+    """
+
+    def __init__(self, loop, rate, burst):
+        self.loop = loop
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = loop.time()
+        self.waiters = collections.deque()
+        self.timer = None
+
+    def refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        self.refill()  # Tokens earned so far were earned at the old rate
+        self.rate = rate
+
+    def acquire(self):
+        future = self.loop.create_future()
+        self.waiters.append(future)
+
+        if self.timer is None:
+            self.release()
+
+        return future
+
+    def release(self):
+        self.timer = None
+        self.refill()
+
+        while self.waiters and self.tokens >= 1:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.tokens -= 1
+
+        if self.waiters:
+            self.timer = self.loop.call_later((1 - self.tokens) / self.rate, self.release)
+
+
+class IcmpProber(object):
+    """
+    Multiplexes ICMP echo requests for any number of hosts over a single socket.
+    Replies are matched back to their request by source address and sequence number (and identifier, for raw sockets).
+    """
+
+    def __init__(self, sock, raw, loop, budget=DEFAULT_BUDGET):
+        self.sock = sock
+        self.raw = raw
+        self.loop = loop
+        self.budget = budget
+        self.bucket = TokenBucket(loop, budget.rate, budget.burst)
+
+        # The kernel rewrites the identifier of datagram sockets, so it is only checked for raw sockets
+        self.identifier = os.getpid() & 0xffff
+        self.sequence = 0
+        self.pending = {}  # (host, sequence) -> (future, send_time)
+
+        # Outcomes of the most recent echo requests, to back off when the network starts dropping them
+        self.window_sent = 0
+        self.window_lost = 0
+
+    def on_readable(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                logger.debug("Could not receive ICMP packet: %s", ex)
+                return
+
+            received_time = self.loop.time()
+
+            if self.raw:
+                data = data[(data[0] & 0x0f) * 4:]  # Strip the IP header
+
+            if len(data) < 8:
+                continue
+
+            icmp_type, _, _, identifier, sequence = struct.unpack('!BBHHH', data[:8])
+            if icmp_type != ICMP_ECHO_REPLY or (self.raw and identifier != self.identifier):
+                continue
+
+            waiter = self.pending.pop((address[0], sequence), None)
+            if waiter:
+                future, send_time = waiter
+                if not future.done():
+                    future.set_result(received_time - send_time)
+
+    def expire(self, key):
+        waiter = self.pending.pop(key, None)
+        if waiter and not waiter[0].done():
+            waiter[0].set_result(None)
+
+    def record_outcome(self, future):
+        if future.cancelled():
+            return  # Benchmarking stopped before the reply (or timeout) came in
+
+        self.window_sent += 1
+        if future.result() is None:
+            self.window_lost += 1
+
+        if self.window_sent < LOSS_WINDOW:
+            return
+
+        loss = self.window_lost / self.window_sent * 100
+        rate = self.bucket.rate
+        self.window_sent = 0
+        self.window_lost = 0
+
+        # Additive increase, multiplicative decrease: halve the rate while losses are high, then creep back towards the budget
+        min_rate = min(self.budget.rate, max(MIN_PROBE_RATE, self.budget.rate * MIN_PROBE_RATE_FRACTION))
+        if loss > self.budget.loss_threshold and rate > min_rate:
+            self.bucket.set_rate(max(min_rate, rate / 2))
+            logger.debug("%0.1f%% of recent pings were lost. Slowing down to %i pings per second.", loss, self.bucket.rate)
+        elif loss <= self.budget.loss_threshold / 2 and rate < self.budget.rate:
+            self.bucket.set_rate(min(self.budget.rate, rate + self.budget.rate / 10))
+
+    async def send_echo(self, host):
+        await self.bucket.acquire()
+
+        self.sequence = (self.sequence + 1) & 0xffff
+        key = (host, self.sequence)
+        future = self.loop.create_future()
+        packet = build_echo_request(self.identifier, self.sequence)
+
+        while True:
+            try:
+                self.sock.sendto(packet, (host, 0))
+                break
+            except (BlockingIOError, InterruptedError):
+                await asyncio.sleep(0.01)  # The socket buffer is full, so give it a moment to drain
+            except OSError as ex:
+                logger.debug("Could not send echo request to %s: %s", host, ex)
+                future.set_result(None)
+                return future
+
+        future.add_done_callback(self.record_outcome)
+        self.pending[key] = (future, self.loop.time())
+        self.loop.call_later(PROBE_TIMEOUT, self.expire, key)
+
+        return future
+
+    async def probe_host(self, host, ping_attempts):
+        replies = []
+        for attempt in range(ping_attempts):
+            if attempt > 0:
+                await asyncio.sleep(PROBE_INTERVAL)
+
+            replies.append(await self.send_echo(host))
+
+        rtts = numpy.array([rtt for rtt in await asyncio.gather(*replies) if rtt is not None]) * 1000  # Milliseconds, as reported by ping
+
+        if len(rtts):
+            loss = (ping_attempts - len(rtts)) / ping_attempts * 100
+            jitter = float(numpy.mean(numpy.abs(numpy.diff(rtts)))) if len(rtts) > 1 else 0.0
+            return scoring.ProbeResult(float(numpy.mean(rtts)), loss, float(numpy.percentile(rtts, 95)), jitter)
+
+        return scoring.FAILED_PROBE
+
+    def iter_results(self, hosts, ping_attempts, deadline=None):
+        # Drive the event loop, yielding (host, ProbeResult) as each host finishes. Stops early once the deadline (a timer() value) passes
+        # Only enough hosts to keep up with the probe rate are probed at once, so they finish in roughly the order given
+        max_probing = max(self.budget.burst, math.ceil(self.budget.rate * ((ping_attempts - 1) * PROBE_INTERVAL + PROBE_TIMEOUT) / ping_attempts))
+
+        waiting = collections.deque(hosts)
+        tasks = {}
+        pending = set()
+        try:
+            while waiting or pending:
+                while waiting and len(pending) < max_probing:
+                    host = waiting.popleft()
+                    task = asyncio.ensure_future(self.probe_host(host, ping_attempts), loop=self.loop)
+                    tasks[task] = host
+                    pending.add(task)
+
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - timer()
+                    if timeout <= 0:
+                        return
+
+                done, pending = self.loop.run_until_complete(asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED))
+
+                for task in done:
+                    yield (tasks.pop(task), task.result())
+        finally:
+            # Stopped early (or interrupted), so tidy up the hosts still being probed
+            for task in pending:
+                task.cancel()
+
+            if pending:
+                self.loop.run_until_complete(asyncio.wait(pending))
+
+
+def iter_icmp_results(icmp_socket, hosts, ping_attempts, budget=DEFAULT_BUDGET, deadline=None):
+    """
+    Benchmark every host from a single process over an open ICMP socket (see open_icmp_socket()).
+    Yields (host, ProbeResult) in the order hosts finish.
+    """
+
+    sock, raw = icmp_socket
+    loop = asyncio.new_event_loop()
+
+    try:
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)  # Avoid dropping replies that arrive in bursts
+
+        prober = IcmpProber(sock, raw, loop, budget)
+        loop.add_reader(sock.fileno(), prober.on_readable)
+
+        yield from prober.iter_results(hosts, ping_attempts, deadline)
+    finally:
+        loop.remove_reader(sock.fileno())
+        loop.close()
+        sock.close()
 
-    return True
+
+def ignore_interrupts():
+    # Ctrl-C is handled by the parent process, which stops the pool itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
 def get_num_processes(num_servers):
@@ -91,28 +340,392 @@ def get_num_processes(num_servers):
         return num_servers
 
 
-def get_best_servers(server_list, ping_attempts, valid_protocols, valid_categories, slow_mode=False):
-    manager = multiprocessing.Manager()
-    best_servers = manager.dict()
+def ping_host(host, ping_attempts):
+    avg_rtt, loss, max_rtt, mdev_rtt = utils.get_rtt_stats(host, ping_attempts)
 
-    num_servers = len(server_list)
+    # ping only reports summary statistics, so its maximum and mean deviation stand in for the p95 RTT and jitter
+    return (host, scoring.ProbeResult(avg_rtt, loss, max_rtt, mdev_rtt))
 
-    if slow_mode:
-        num_processes = multiprocessing.cpu_count()
-    else:
-        num_processes = get_num_processes(num_servers)
 
-    pool = multiprocessing.Pool(num_processes, maxtasksperchild=1)
+def ping_hosts(hosts, ping_attempts):
+    return [ping_host(host, ping_attempts) for host in hosts]
+
+
+def iter_ping_results(hosts, ping_attempts, budget=DEFAULT_BUDGET, deadline=None):
+    """
+    Benchmark every host with a pool of 'ping' processes, yielding (host, ProbeResult) in the order hosts finish.
+    Workers are long-lived and take hosts in chunks, so only plain results cross the process boundary.
+    """
+
+    num_hosts = len(hosts)
+    if num_hosts == 0:
+        return
+
+    # Each ping process sends one echo request every PROBE_INTERVAL, so the budget decides how many can run at once
+    num_processes = min(get_num_processes(num_hosts), max(1, math.ceil(budget.rate * PROBE_INTERVAL)))
+
+    # A few chunks per worker keeps the IPC overhead low, without leaving workers idle at the end
+    chunk_size = max(1, num_hosts // (num_processes * 4))
+
+    chunks = [hosts[i:i + chunk_size] for i in range(0, num_hosts, chunk_size)]
+
+    # Chunks are handed out one at a time (rather than by imap's chunksize), so waiting on each can time out at the deadline
+    with multiprocessing.Pool(num_processes, initializer=ignore_interrupts) as pool:
+        results = pool.imap_unordered(partial(ping_hosts, ping_attempts=ping_attempts), chunks)
+
+        for _ in range(len(chunks)):
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - timer()
+                if timeout <= 0:
+                    return
+
+            try:
+                yield from results.next(timeout)
+            except multiprocessing.TimeoutError:
+                return
+
+
+def get_probe_arrays(catalog, probe_results, indexes=None):
+    # Gather the load, RTT, p95 RTT, jitter and loss of every server (or those at indexes) into arrays. Servers which weren't (or couldn't be) benchmarked have an RTT of NaN
+    if indexes is None:
+        indexes = numpy.arange(len(catalog))
+
+    num_servers = len(indexes)
+    loads = catalog.loads[indexes].astype(float)
+    rtts = numpy.full(num_servers, numpy.nan)
+    p95s = numpy.full(num_servers, numpy.nan)
+    jitters = numpy.full(num_servers, numpy.nan)
+    losses = numpy.full(num_servers, 100.0)
+
+    # If a server is at 95% load or greater, it was never probed
+    for i in numpy.flatnonzero(loads < MAX_LOAD):
+        result = probe_results.get(catalog.ip_addresses[indexes[i]], scoring.FAILED_PROBE)
+        if result.rtt:
+            rtts[i] = result.rtt
+            losses[i] = result.loss
+
+            if result.p95 is not None:
+                p95s[i] = result.p95
+            if result.jitter is not None:
+                jitters[i] = result.jitter
+
+    return (loads, rtts, p95s, jitters, losses)
+
+
+def get_server_scores(probe_arrays, weights=scoring.DEFAULT_WEIGHTS):
+    return scoring.get_scores(weights, *probe_arrays, max_load=MAX_LOAD)
+
+
+def get_bucket_members(catalog, valid_protocols, valid_categories):
+    # Flatten bucket membership into parallel arrays of (bucket id, server index), with bucket_keys mapping ids back to keys
+    return catalog.get_bucket_members(valid_protocols, valid_categories)
+
+
+def get_bucket_ranks(member_buckets, member_servers, scores):
+    # Sort bucket members by bucket, then by descending score, numbering each member by its position within its bucket. Ties are won by the earliest (least loaded) server
+    order = numpy.lexsort((member_servers, -scores[member_servers], member_buckets))
+    member_buckets = member_buckets[order]
+    member_servers = member_servers[order]
+
+    bucket_starts = numpy.flatnonzero(numpy.r_[True, member_buckets[1:] != member_buckets[:-1]])
+    bucket_sizes = numpy.diff(numpy.r_[bucket_starts, len(member_buckets)])
+    ranks = numpy.arange(len(member_buckets)) - numpy.repeat(bucket_starts, bucket_sizes)
+
+    return (member_buckets, member_servers, ranks)
+
+
+def rank_bucket_members(member_buckets, member_servers, scores, benchmarked, num_ranks):
+    # Returns the (bucket id, server index) pairs of the num_ranks highest scoring benchmarked servers of every bucket
+    eligible = benchmarked[member_servers]
+    member_buckets, member_servers, ranks = get_bucket_ranks(member_buckets[eligible], member_servers[eligible], scores)
+
+    top_ranked = ranks < num_ranks
+    return (member_buckets[top_ranked], member_servers[top_ranked])
+
+
+def get_candidate_servers(catalog, probe_results, valid_protocols, valid_categories, num_candidates, weights=scoring.DEFAULT_WEIGHTS):
+    # Find the top scoring servers of every bucket, plus every server whose sweep probe got no reply, keeping the order of the catalog
+    probe_arrays = get_probe_arrays(catalog, probe_results)
+    rtts = probe_arrays[1]
+    scores = get_server_scores(probe_arrays, weights)
+
+    _, member_buckets, member_servers = get_bucket_members(catalog, valid_protocols, valid_categories)
+    _, candidate_indexes = rank_bucket_members(member_buckets, member_servers, scores, ~numpy.isnan(rtts), num_candidates)
+
+    # A single lost probe says little about a server, and could leave a bucket with no benchmarked server at all. So those get the full number of attempts too
+    failed_indexes = numpy.flatnonzero(numpy.isnan(rtts) & (catalog.loads < MAX_LOAD))
+
+    return catalog.subset(numpy.union1d(candidate_indexes, failed_indexes))
+
+
+def get_probe_order(catalog, past_results, valid_protocols, valid_categories, weights=scoring.DEFAULT_WEIGHTS):
+    """
+    Orders servers by the expected value of probing them, so a time-limited benchmark finds good servers for every bucket first.
+    The likely best server of each bucket comes first, then the second best of each, and so on. Servers are expected
+    to score as they did in past_results, or (if never benchmarked) as if they had the median RTT of those that were.
+    """
+
+    if not len(catalog):
+        return catalog
+
+    known_rtts = [result.rtt for result in past_results.values() if result.rtt]
+    typical_result = scoring.ProbeResult(float(numpy.median(known_rtts)) if known_rtts else 1.0, 0, None, None)
+
+    expected_results = {host: past_results.get(host, typical_result) for host in catalog.ip_addresses}
+    expected_scores = get_server_scores(get_probe_arrays(catalog, expected_results), weights)
+
+    # A server's priority is its best rank in any of its buckets
+    _, member_buckets, member_servers = get_bucket_members(catalog, valid_protocols, valid_categories)
+    _, member_servers, ranks = get_bucket_ranks(member_buckets, member_servers, expected_scores)
+
+    priorities = numpy.full(len(catalog), len(catalog))
+    numpy.minimum.at(priorities, member_servers, ranks)
+
+    order = numpy.lexsort((numpy.arange(len(catalog)), -expected_scores, priorities))
+    return catalog.subset(order)
+
+
+def get_hosts(catalog):
+    # Servers can share an address, so only probe each one once
+    hosts = []
+    seen_hosts = set()
+    for index in numpy.flatnonzero(catalog.loads < MAX_LOAD):
+        host = catalog.ip_addresses[index]
+        if host not in seen_hosts:
+            seen_hosts.add(host)
+            hosts.append(host)
+
+    return hosts
+
+
+class BestServerTable(object):
+    """
+    The best server of every (country, category, protocol) bucket, updated as each benchmark result arrives.
+    Ties are won by the earliest (least loaded) server, so the table ends up the same whatever order results arrive in.
+    """
+
+    def __init__(self, catalog, valid_protocols, valid_categories, weights=scoring.DEFAULT_WEIGHTS):
+        self.catalog = catalog
+        self.weights = weights
+        self.best = {}  # bucket -> (score, server index, best server entry)
+
+        self.server_buckets = [[] for _ in range(len(catalog))]
+        bucket_keys, member_buckets, member_servers = get_bucket_members(catalog, valid_protocols, valid_categories)
+        for bucket, index in zip(member_buckets.tolist(), member_servers.tolist()):
+            self.server_buckets[index].append(bucket_keys[bucket])
+
+        # Servers can share an address, so one result may update several servers
+        self.host_servers = {}
+        for index in numpy.flatnonzero(catalog.loads < MAX_LOAD).tolist():
+            self.host_servers.setdefault(catalog.ip_addresses[index], []).append(index)
+
+    @property
+    def best_servers(self):
+        return {key: best[2] for key, best in self.best.items()}
+
+    def update(self, host, result):
+        # Returns how many servers were benchmarked successfully by this result
+        indexes = self.host_servers.get(host, [])
+        if not result.rtt:
+            return 0
+
+        for index in indexes:
+            load = int(self.catalog.loads[index])
+            score = scoring.get_score(self.weights, load, result, MAX_LOAD)
+
+            for key in self.server_buckets[index]:
+                best = self.best.get(key)
+
+                if best is None or score > best[0] or (score == best[0] and index < best[1]):
+                    self.best[key] = (score, index, {
+                        'name': self.catalog.get_connection_name(index, key[2]),
+                        'domain': self.catalog.domains[index],
+                        'score': score,
+                        'load': load,
+                        'latency': float(result.rtt),
+                        'p95': float('nan') if result.p95 is None else float(result.p95),
+                        'jitter': float('nan') if result.jitter is None else float(result.jitter),
+                        'loss': float(result.loss),
+                    })
+
+        return len(indexes)
+
+
+class Benchmark(object):
+    """
+    Benchmarks a ServerCatalog, keeping a best server table that is updated as each result arrives.
+    Iterating results() yields (host, ProbeResult) in the order hosts finish, while run() reports progress
+    and returns the best servers found, even if interrupted by Ctrl-C or the deadline.
+    """
+
+    def __init__(self, catalog, ping_attempts, valid_protocols, valid_categories, budget=DEFAULT_BUDGET, refine_candidates=0, probe_cache=None, weights=scoring.DEFAULT_WEIGHTS):
+        self.catalog = catalog
+        self.ping_attempts = ping_attempts
+        self.valid_protocols = valid_protocols
+        self.valid_categories = valid_categories
+        self.budget = budget
+        self.refine_candidates = refine_candidates
+        self.probe_cache = probe_cache
+        self.weights = weights
+
+        self.use_icmp = True
+        self.deadline = None
+        self.complete = False
+        self.num_success = 0
+        self.phase_hosts = 0  # Number of hosts being probed in the current phase
+
+        # Without refinement (or with only one attempt to make anyway), every server gets the full number of attempts in a single phase
+        self.two_phase = bool(refine_candidates) and ping_attempts > 1
+        self.coarse_table = BestServerTable(catalog, valid_protocols, valid_categories, weights)
+        self.table = self.coarse_table
+
+        # Results are only taken from the cache up front, so servers swept below are still refined. A cached sweep (a single
+        # ping) can stand in for another sweep, but only a result with the full number of attempts can stand in for refinement
+        self.cached_results = {}
+        self.cached_refined_results = {}
+        past_results = {}
+        if probe_cache:
+            hosts = get_hosts(catalog)
+            self.cached_refined_results = probe_cache.get_fresh_results(hosts, ping_attempts)
+            self.cached_results = probe_cache.get_fresh_results(hosts) if self.two_phase else self.cached_refined_results
+            if self.cached_results:
+                logger.info("Using cached results for %i recently benchmarked servers.", len(self.cached_results))
+
+            past_results = probe_cache.get_results(hosts)
+
+        self.probe_order = get_probe_order(catalog, past_results, valid_protocols, valid_categories, weights)
+        self.coarse_results = {}
+
+    @property
+    def best_servers(self):
+        best_servers = self.table.best_servers
+
+        # If every refined candidate of a bucket failed (or hasn't finished yet), the sweep result is still better than nothing
+        if self.table is not self.coarse_table:
+            for key, server in self.coarse_table.best_servers.items():
+                if key not in best_servers:
+                    best_servers[key] = server
+
+        return best_servers
+
+    def iter_probe_results(self, hosts, ping_attempts, cached_results):
+        self.phase_hosts = len(hosts)
+
+        for host in hosts:
+            if host in cached_results:
+                yield (host, cached_results[host])
+
+        hosts = [host for host in hosts if host not in cached_results]
+        if not hosts:
+            return
+
+        results = None
+        if self.use_icmp:
+            icmp_socket = open_icmp_socket()
+            if icmp_socket:
+                results = iter_icmp_results(icmp_socket, hosts, ping_attempts, self.budget, self.deadline)
+            else:
+                self.use_icmp = False
+                logger.warning("Could not open an ICMP socket. Falling back to benchmarking with 'ping' processes.")
+
+        if results is None:
+            results = iter_ping_results(hosts, ping_attempts, self.budget, self.deadline)
+
+        for host, result in results:
+            if self.probe_cache:
+                self.probe_cache.update({host: result}, ping_attempts)
+
+            yield (host, result)
+
+    def results(self):
+        # Phase one: every server (with a single probe, if refining afterwards)
+        hosts = get_hosts(self.probe_order)
+        coarse_results = self.coarse_results
+
+        for host, result in self.iter_probe_results(hosts, 1 if self.two_phase else self.ping_attempts, self.cached_results):
+            coarse_results[host] = result
+            self.num_success += self.coarse_table.update(host, result)
+            yield (host, result)
+
+        if len(coarse_results) < len(hosts):
+            return  # Out of time
+
+        if self.two_phase:
+            candidates = get_candidate_servers(self.catalog, coarse_results, self.valid_protocols, self.valid_categories, self.refine_candidates, self.weights)
+
+            if len(candidates):
+                # Phase two: re-probe only the top candidates of each bucket with the full number of attempts
+                logger.info("Refining %i candidate servers...", len(candidates))
+                self.table = BestServerTable(candidates, self.valid_protocols, self.valid_categories, self.weights)
+
+                hosts = get_hosts(get_probe_order(candidates, coarse_results, self.valid_protocols, self.valid_categories, self.weights))
+                num_refined = 0
+                for host, result in self.iter_probe_results(hosts, self.ping_attempts, self.cached_refined_results):
+                    num_refined += 1
+                    num_success = self.table.update(host, result)
+                    if not coarse_results[host].rtt:
+                        self.num_success += num_success  # Lost its sweep probe, so it wasn't counted then
+                    yield (host, result)
+
+                if num_refined < len(hosts):
+                    return
+
+        self.complete = True
+
+    def get_partial_buckets(self):
+        # Returns {bucket: (servers benchmarked, servers to benchmark)} for every bucket not fully swept
+        catalog = self.catalog
+        bucket_keys, member_buckets, member_servers = get_bucket_members(catalog, self.valid_protocols, self.valid_categories)
+
+        probed = numpy.array([host in self.coarse_results for host in catalog.ip_addresses], dtype=bool)
+        probing = catalog.loads < MAX_LOAD
+
+        num_probed = numpy.bincount(member_buckets, weights=probed[member_servers], minlength=len(bucket_keys))
+        num_servers = numpy.bincount(member_buckets, weights=probing[member_servers], minlength=len(bucket_keys))
+
+        return {key: (int(num_probed[i]), int(num_servers[i])) for i, key in enumerate(bucket_keys) if num_probed[i] < num_servers[i]}
+
+    def deadline_passed(self):
+        return self.deadline is not None and timer() >= self.deadline
+
+    def run(self, deadline=None):
+        """
+        Benchmark until finished, interrupted by Ctrl-C or past the deadline (a timer() value).
+        Returns (best_servers, num_success) either way. Check self.complete to tell them apart.
+        """
+
+        self.deadline = deadline
+
+        # Make Ctrl-C interrupt benchmarking, rather than exit straight away
+        previous_handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        results = self.results()
+        num_finished = 0
+        try:
+            for _ in results:
+                num_finished += 1
+                sys.stderr.write("\r[INFO] %i/%i benchmarks finished." % (num_finished, self.phase_hosts))
 
-    results = []
-    for i, result in enumerate(pool.imap(partial(compare_server, best_servers=best_servers, ping_attempts=ping_attempts, valid_protocols=valid_protocols, valid_categories=valid_categories), server_list)):
-        sys.stderr.write("\r[INFO] %i/%i benchmarks finished." % (i + 1, num_servers))
-        results.append(result)
+                if num_finished == self.phase_hosts:
+                    num_finished = 0
+                    sys.stderr.write('\n')
+        except KeyboardInterrupt:
+            sys.stderr.write('\n')
+            logger.warning("Benchmarking interrupted. Using the best servers found so far.")
+        finally:
+            results.close()
+            signal.signal(signal.SIGINT, previous_handler)
+
+        if num_finished:
+            sys.stderr.write('\n')
 
-    sys.stderr.write('\n')
+        if self.deadline_passed():
+            logger.warning("Benchmarking deadline reached. Using the best servers found so far.")
 
-    pool.close()
+        return (self.best_servers, self.num_success)
 
-    num_success = results.count(True)
 
-    return (best_servers, num_success)
+def get_best_servers(catalog, ping_attempts, valid_protocols, valid_categories, budget=DEFAULT_BUDGET, refine_candidates=0, probe_cache=None, weights=scoring.DEFAULT_WEIGHTS, deadline=None):
+    benchmark = Benchmark(catalog, ping_attempts, valid_protocols, valid_categories, budget, refine_candidates, probe_cache, weights)
+    return benchmark.run(deadline)
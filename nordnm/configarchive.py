@@ -0,0 +1,162 @@
+import logging
+import os
+import pickle
+import re
+from zipfile import ZipFile
+
+logger = logging.getLogger(__name__)
+
+# Config file names look like 'us123.nordvpn.com.udp.ovpn' (or 'us123.nordvpn.com.udp1194.ovpn' in older archives)
+MEMBER_PATTERN = re.compile(r'^(?P<domain>.+)\.(?P<protocol>tcp|udp)\d*\.ovpn$')
+
+
+def get_member_key(member_name):
+    # Returns the (domain, protocol) of an archive member, or None if it isn't an OpenVPN config
+    match = MEMBER_PATTERN.match(os.path.basename(member_name))
+    if not match:
+        return None
+
+    return (match.group('domain'), match.group('protocol'))
+
+
+def get_manifest(zip_file):
+    # Maps the name of every config in an open archive to the CRC32 of its contents
+    return {info.filename: info.CRC for info in zip_file.infolist() if get_member_key(info.filename)}
+
+
+def get_archive_stamp(path):
+    # Identifies one download of the archive, so a saved index can be matched to it
+    info = os.stat(path)
+    return (info.st_size, info.st_mtime)
+
+
+def load_manifest(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def save_manifest(manifest, path):
+    try:
+        with open(path, 'wb') as f:
+            pickle.dump(manifest, f)
+
+        return True
+    except Exception as ex:
+        logger.error("Could not save the configuration manifest: %s", ex)
+        return False
+
+
+class ConfigArchive(object):
+    """
+    The downloaded OpenVPN configuration archive, from which configs are only extracted when they are needed.
+    Members are indexed by (domain, protocol), and extracted to the same relative path under output_path.
+    """
+
+    def __init__(self, path, output_path, index_path=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.output_path = output_path
+        self.index_path = index_path  # If given, the index is saved here so later runs don't need to scan the archive
+        self.index = None  # (domain, protocol) -> member name
+        self.manifest = None  # Member name -> CRC32
+        self.zip_file = None
+
+    def get_zip_file(self):
+        # Kept open, as reading the archive's directory costs as much as the extraction of a single config
+        if self.zip_file is None:
+            self.zip_file = ZipFile(self.path)
+
+        return self.zip_file
+
+    def close(self):
+        if self.zip_file is not None:
+            self.zip_file.close()
+            self.zip_file = None
+
+    def load_index(self):
+        index = {}
+        zip_file = self.get_zip_file()
+        self.manifest = get_manifest(zip_file)
+        for member_name in zip_file.namelist():
+            key = get_member_key(member_name)
+            if key and key not in index:
+                index[key] = member_name
+
+        self.index = index
+        self.save_index()
+
+        return index
+
+    def save_index(self):
+        if not self.index_path:
+            return False
+
+        try:
+            with open(self.index_path, 'wb') as f:
+                pickle.dump((get_archive_stamp(self.path), self.index), f)
+
+            return True
+        except Exception as ex:
+            self.logger.warning("Could not save the configuration index: %s", ex)
+            return False
+
+    def load_saved_index(self):
+        # Loads the saved index, if it was built from the archive as it is now
+        try:
+            with open(self.index_path, 'rb') as f:
+                stamp, index = pickle.load(f)
+        except Exception:
+            return False
+
+        if stamp != get_archive_stamp(self.path):
+            return False
+
+        self.index = index
+        return True
+
+    def get_member(self, domain, protocol):
+        if self.index is None and not (self.index_path and self.load_saved_index()):
+            self.load_index()
+
+        return self.index.get((domain, protocol))
+
+    def get_config_path(self, domain, protocol):
+        # Returns the path of the extracted config for this server, extracting it first if needed. None if the archive has no such config
+        member_name = self.get_member(domain, protocol)
+        if not member_name:
+            return None
+
+        config_path = os.path.join(self.output_path, member_name)
+        if not os.path.isfile(config_path):
+            config_path = self.get_zip_file().extract(member_name, self.output_path)
+
+        return config_path
+
+    def update(self, old_manifest):
+        """
+        Brings the configs already extracted into line with the archive, given the manifest of the archive they came from.
+        Only configs that were changed or removed are touched. Returns the set of domains whose configs were added, changed or removed.
+        """
+
+        self.load_index()
+
+        changed = set(name for name, crc in self.manifest.items() if old_manifest.get(name) != crc)
+        removed = set(old_manifest) - set(self.manifest)
+
+        zip_file = self.get_zip_file()
+        for member_name in changed:
+            if os.path.isfile(os.path.join(self.output_path, member_name)):
+                zip_file.extract(member_name, self.output_path)
+
+        for member_name in removed:
+            config_path = os.path.join(self.output_path, member_name)
+            if os.path.isfile(config_path):
+                os.remove(config_path)
+
+        self.logger.debug("%i configs added or changed, %i removed.", len(changed), len(removed))
+
+        return set(get_member_key(member_name)[0] for member_name in changed | removed)
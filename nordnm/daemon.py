@@ -0,0 +1,234 @@
+from nordnm import networkmanager
+from nordnm import paths
+from nordnm import utils
+
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import time
+
+DEFAULT_INTERVAL = 15 * 60  # Seconds between scheduled re-benchmarks
+CONNECT_TIMEOUT = 5  # Seconds a client waits to connect to the daemon, before running the command itself
+MAX_REQUEST_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def connect_socket(path, timeout=None):
+    # Connects as root, since only root can reach the socket. Returns None if nothing is listening
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        utils.run_as_root(lambda: sock.connect(path))
+        return sock
+    except OSError as ex:
+        logger.debug("Could not connect to the daemon: %s", ex)
+        sock.close()
+        return None
+
+
+def send_request(request, path=None):
+    """
+    Sends a request to the daemon, if one is running, and waits for its reply as {'status': exit status, 'output': text}.
+    Returns None if no daemon could be reached, and the command should be run by the client instead. Once the request
+    is sent, the client always waits for the daemon, even if it is busy, so a command never runs twice.
+    """
+
+    sock = connect_socket(path or paths.DAEMON_SOCKET, CONNECT_TIMEOUT)
+    if sock is None:
+        return None
+
+    with sock:
+        sock.settimeout(None)
+        try:
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        except OSError as ex:
+            logger.debug("Could not send the request to the daemon: %s", ex)
+            return None
+
+        try:
+            with sock.makefile('rb') as f:
+                return json.loads(f.readline().decode('utf-8'))
+        except (OSError, ValueError) as ex:
+            logger.error("Lost the connection to the daemon: %s", ex)
+            return {'status': 1, 'output': ''}
+
+
+def daemon_is_running(path):
+    sock = connect_socket(path)
+    if sock is None:
+        return False
+
+    sock.close()
+    return True
+
+
+def get_peer_uid(sock):
+    # The effective user id of the process at the other end of a Unix socket, when it connected
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+
+    return uid
+
+
+class DaemonStopped(BaseException):
+    """
+    Raised by the SIGTERM handler. Not an Exception (or SystemExit), so it isn't swallowed by the handlers that absorb the
+    sys.exit() calls of a failed sync, and stops the daemon even in the middle of a request or scheduled sync.
+    """
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # Requests are run as root, so only take them from root. The socket's permissions should already see to that
+        uid = get_peer_uid(self.request)
+        if uid != 0:
+            logger.warning("Rejected a request from user %i.", uid)
+            reply = {'status': 1, 'output': "Permission denied.\n"}
+        else:
+            try:
+                request = json.loads(self.rfile.readline(MAX_REQUEST_SIZE).decode('utf-8'))
+            except ValueError:
+                reply = {'status': 1, 'output': "Invalid request.\n"}
+            else:
+                reply = self.server.nordnm_daemon.handle_request(request)
+
+        try:
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+        except OSError as ex:
+            logger.warning("Could not send the reply, as the client went away: %s", ex)
+
+
+class Daemon(object):
+    """
+    Keeps a NordNM instance running, and with it the server list, probe history and NetworkManager connection snapshot.
+    Servers are re-benchmarked every interval seconds, and 'sync' and 'connect' requests from nordnm clients are
+    answered over a Unix socket. Requests and scheduled syncs are handled one at a time.
+    """
+
+    def __init__(self, nordnm, interval=DEFAULT_INTERVAL, time_budget=None, socket_path=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.nordnm = nordnm
+        self.interval = interval
+        self.time_budget = time_budget  # Scheduled syncs stop benchmarking after this many seconds, probing the likeliest best servers first
+        self.socket_path = socket_path or paths.DAEMON_SOCKET
+        self.next_sync = time.time()
+        self.stopping = False
+
+        self.commands = {
+            'sync': self.sync,
+            'connect': self.connect,
+        }
+
+    def handle_request(self, request):
+        command = self.commands.get(request.get('command'))
+        if not command:
+            return {'status': 1, 'output': "Unknown command '%s'.\n" % request.get('command')}
+
+        # Connections may have been changed outside nordnm since the last request
+        networkmanager.invalidate_connections()
+
+        # The client gets everything printed or logged while handling its request
+        output = io.StringIO()
+        log_handler = logging.StreamHandler(output)
+        log_handler.setFormatter(utils.LoggingFormatter())
+        logging.root.addHandler(log_handler)
+
+        status = 0
+        try:
+            with contextlib.redirect_stdout(output):
+                if not command(request):
+                    status = 1
+        except SystemExit as ex:
+            status = ex.code if isinstance(ex.code, int) else 1
+        except Exception as ex:
+            self.logger.exception("Could not handle the request: %s", ex)
+            status = 1
+        finally:
+            logging.root.removeHandler(log_handler)
+
+        return {'status': status, 'output': output.getvalue()}
+
+    def sync(self, request):
+        self.nordnm.setup()  # Picks up any changes to the settings or credentials
+        try:
+            self.nordnm.sync(request.get('update_config', True), request.get('preserve_vpn', False), request.get('slow_mode', False), request.get('time_budget'))
+        finally:
+            if request.get('http_timings'):
+                self.nordnm.print_http_timings()
+
+        self.next_sync = time.time() + self.interval
+
+        return True
+
+    def connect(self, request):
+        self.nordnm.active_servers = self.nordnm.load_active_servers()
+        return self.nordnm.connect(*request['server'])
+
+    def run_scheduled_sync(self):
+        self.nordnm.setup()
+        networkmanager.invalidate_connections()
+
+        # Benchmarking through the tunnel gives misleading results, and disconnecting it would leave the user unprotected
+        if networkmanager.get_active_vpns(self.nordnm.active_servers):
+            self.logger.info("Skipping the scheduled sync, as a VPN is connected.")
+            return
+
+        self.logger.info("Running the scheduled sync...")
+        try:
+            self.nordnm.sync(True, True, False, self.time_budget)
+        except SystemExit:
+            self.logger.error("The scheduled sync failed.")
+
+    def bind(self):
+        # Run as root, so the socket belongs to root, in a directory only root can enter
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+        self.remove_socket()  # Left behind by a daemon that didn't exit cleanly
+
+        server = socketserver.UnixStreamServer(self.socket_path, RequestHandler)
+        os.chmod(self.socket_path, 0o600)
+
+        return server
+
+    def remove_socket(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def serve(self):
+        if daemon_is_running(self.socket_path):
+            self.logger.error("The daemon is already running.")
+            return False
+
+        server = utils.run_as_root(self.bind)
+        server.nordnm_daemon = self
+
+        def stop(signum, frame):
+            self.stopping = True
+            raise DaemonStopped()
+
+        signal.signal(signal.SIGTERM, stop)
+
+        self.logger.info("Listening on '%s'. Syncing every %i minutes.", self.socket_path, self.interval // 60)
+        try:
+            while not self.stopping:
+                server.timeout = max(0, self.next_sync - time.time())
+                server.handle_request()
+
+                if not self.stopping and time.time() >= self.next_sync:
+                    self.run_scheduled_sync()
+                    self.next_sync = time.time() + self.interval
+        except DaemonStopped:
+            pass
+        finally:
+            server.server_close()
+            utils.run_as_root(self.remove_socket)
+
+        self.logger.info("Stopped.")
+        return True
@@ -0,0 +1,198 @@
+import collections
+import logging
+import os
+import random
+import re
+import time
+from timeit import default_timer as timer
+
+CONNECT_TIMEOUT = 5  # Seconds to wait for a connection to be established
+READ_TIMEOUT = 10  # Seconds to wait between bytes of a response
+RETRIES = 2  # Extra attempts made at idempotent requests that fail with a connection error or a temporary server error
+BACKOFF = 0.5  # Seconds. Retries wait a random time of up to BACKOFF, then 2 * BACKOFF, 4 * BACKOFF...
+
+RETRY_METHODS = ['GET', 'HEAD']
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_TIMINGS = 100
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes written to disk at a time when downloading files
+
+# How a request went, for diagnostics. elapsed is in seconds, and covers every attempt (including backoff) up to the response headers
+RequestTiming = collections.namedtuple('RequestTiming', ['method', 'url', 'status', 'attempts', 'elapsed'])
+
+logger = logging.getLogger(__name__)
+
+session = None
+timings = collections.deque(maxlen=MAX_TIMINGS)
+
+
+def configure(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES):
+    global CONNECT_TIMEOUT, READ_TIMEOUT, RETRIES
+
+    CONNECT_TIMEOUT = connect_timeout
+    READ_TIMEOUT = read_timeout
+    RETRIES = retries
+
+
+def get_session():
+    # One session for the whole process, so connections to the same host are kept alive and reused
+    global session
+
+    if session is None:
+        import requests  # Deferred, as it takes longer to import than most commands take to run
+
+        session = requests.Session()
+
+    return session
+
+
+def get_timings():
+    return list(timings)
+
+
+def clear_timings():
+    timings.clear()
+
+
+def get_backoff(attempt):
+    # "Full jitter", so clients that failed together don't all retry together
+    return random.uniform(0, BACKOFF * 2 ** attempt)
+
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    """
+    Makes a request through the shared session, retrying idempotent requests that fail temporarily.
+    timeout defaults to (CONNECT_TIMEOUT, READ_TIMEOUT). Returns the response, or raises the last
+    requests exception if every attempt failed to get one.
+    """
+
+    import requests
+
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    if retries is None:
+        retries = RETRIES if method in RETRY_METHODS else 0
+
+    start = timer()
+    attempt = 0
+    while True:
+        try:
+            resp = get_session().request(method, url, timeout=timeout, **kwargs)
+            if resp.status_code not in RETRY_STATUSES or attempt >= retries:
+                break
+
+            logger.debug("%s %s returned %i. Retrying.", method, url, resp.status_code)
+            resp.close()
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            if attempt >= retries:
+                timings.append(RequestTiming(method, url, None, attempt + 1, timer() - start))
+                raise
+
+            logger.debug("%s %s failed (%s). Retrying.", method, url, ex)
+
+        time.sleep(get_backoff(attempt))
+        attempt += 1
+
+    timing = RequestTiming(method, url, resp.status_code, attempt + 1, timer() - start)
+    timings.append(timing)
+    logger.debug("%s %s returned %i after %i attempt(s) in %0.3f seconds.", method, url, resp.status_code, timing.attempts, timing.elapsed)
+
+    return resp
+
+
+def conditional_get(url, etag=None, last_modified=None, **kwargs):
+    # A GET that the server can answer with 304 Not Modified, if the resource still matches the given validators. Redirects are followed
+    headers = kwargs.pop('headers', {})
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    return request('GET', url, headers=headers, **kwargs)
+
+
+def read_part_etag(part_path):
+    try:
+        with open(part_path + '.etag', 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def remove_part(part_path):
+    for path in (part_path, part_path + '.etag'):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def download(url, path, etag=None):
+    """
+    Streams url into path, unless its ETag still matches etag. Returns the new ETag (or None if not modified).
+    The file is downloaded to path + '.part' first, and only replaces path once its size (and ETag) check out.
+    An interrupted download is resumed with a Range request next time, if the file hasn't changed since.
+    Raises IOError (or a requests exception) if the download fails.
+    """
+
+    part_path = path + '.part'
+
+    for _ in range(2):  # A second attempt starts from scratch, if the partial download can't be resumed
+        headers = {'Accept-Encoding': 'identity'}  # Sizes must be those of the file itself
+
+        offset = 0
+        part_etag = read_part_etag(part_path)
+        if part_etag and os.path.isfile(part_path):
+            offset = os.path.getsize(part_path)
+            if offset:
+                headers['Range'] = 'bytes=%i-' % offset
+                headers['If-Range'] = part_etag
+
+        resp = conditional_get(url, etag, headers=headers, stream=True)
+        try:
+            if resp.status_code == 304:
+                return None
+            elif resp.status_code == 416:
+                logger.debug("Could not resume downloading %s. Starting again.", url)
+                remove_part(part_path)
+                continue
+
+            resp.raise_for_status()
+
+            new_etag = resp.headers.get('etag')
+            if resp.status_code == 206:
+                # Only resumed if the file still has the ETag of the partial download (If-Range), otherwise the server sends all of it
+                content_range = re.match(r'bytes (\d+)-\d+/(\d+)', resp.headers.get('content-range', ''))
+                if not content_range or int(content_range.group(1)) != offset or new_etag != part_etag:
+                    remove_part(part_path)
+                    continue
+
+                expected_size = int(content_range.group(2))
+                mode = 'ab'
+            else:
+                # Not every server honours If-None-Match
+                if etag and new_etag == etag:
+                    return None
+
+                content_length = resp.headers.get('content-length')
+                expected_size = int(content_length) if content_length else None
+                mode = 'wb'
+
+                remove_part(part_path)
+                if new_etag:
+                    with open(part_path + '.etag', 'w') as f:
+                        f.write(new_etag)
+
+            with open(part_path, mode) as f:
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+            size = os.path.getsize(part_path)
+            if expected_size is not None and size != expected_size:
+                raise IOError("Downloaded %i of %i bytes from %s" % (size, expected_size, url))
+
+            os.replace(part_path, path)
+            remove_part(part_path)
+
+            return new_etag
+        finally:
+            resp.close()
+
+    raise IOError("Could not download %s" % url)
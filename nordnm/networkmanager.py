@@ -5,12 +5,19 @@ import subprocess
 import shutil
 import os
 import configparser
+import json
 import logging
-from distutils.version import LooseVersion
+from collections import namedtuple
 import re
 
+Connection = namedtuple('Connection', ['name', 'uuid', 'type'])
+
 logger = logging.getLogger(__name__)
 
+# Snapshot of NetworkManager's connections as {name: Connection}, loaded on first use. It is kept up to date as connections
+# are imported and removed here, and dropped whenever NetworkManager reloads its connections
+connections = None
+
 
 def restart():
     def main():
@@ -59,6 +66,8 @@ def get_version():
 
 def reload_connections():
     def main():
+        invalidate_connections()
+
         try:
             output = subprocess.run(['nmcli', 'connection', 'reload'],
                                     stdout=subprocess.PIPE,
@@ -80,33 +89,91 @@ def reload_connections():
     return utils.run_as_root(main)
 
 
-def get_vpn_connections():
-    try:
-        output = subprocess.run([
-            'nmcli', '--mode', 'tabular', '--terse', '--fields', 'TYPE,NAME',
-            'connection', 'show'
-        ],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        output.check_returncode()
+def split_terse_line(line):
+    # Fields in nmcli's terse output are separated by ':', with any ':' or '\\' within a field escaped by a backslash
+    fields = ['']
+    escaped = False
+    for char in line:
+        if escaped:
+            fields[-1] += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == ':':
+            fields.append('')
+        else:
+            fields[-1] += char
+
+    return fields
+
+
+def get_connections():
+    global connections
+
+    if connections is None:
+        try:
+            output = subprocess.run([
+                'nmcli', '--mode', 'tabular', '--terse', '--fields', 'NAME,UUID,TYPE',
+                'connection', 'show'
+            ],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output.check_returncode()
+
+        except subprocess.CalledProcessError:
+            error = utils.format_std_string(output.stderr)
+            logger.error(error)
+            return False
 
         lines = output.stdout.decode('utf-8').split('\n')
 
-        vpn_connections = []
+        snapshot = {}
         for line in lines:
             if line:
-                elements = line.strip().split(':')
+                elements = split_terse_line(line.strip())
+                if len(elements) == 3:
+                    connection = Connection(*elements)
+                    snapshot[connection.name] = connection
 
-                if (elements[0] == 'vpn'):
-                    vpn_connections.append(elements[1])
+        connections = snapshot
 
-        return vpn_connections
+    return connections
 
-    except subprocess.CalledProcessError:
-        error = utils.format_std_string(output.stderr)
-        logger.error(error)
+
+def invalidate_connections():
+    global connections
+
+    connections = None
+
+
+def record_connection(connection_name, uuid, connection_type='vpn'):
+    if connections is not None:
+        if uuid:
+            connections[connection_name] = Connection(connection_name, uuid, connection_type)
+        else:
+            invalidate_connections()  # Can't tell what was added, so reload next time
+
+
+def forget_connection(connection_name):
+    if connections is not None:
+        connections.pop(connection_name, None)
+
+
+def get_vpn_connections():
+    snapshot = get_connections()
+    if snapshot is False:
+        return False
+
+    return [connection.name for connection in snapshot.values() if connection.type == 'vpn']
+
+
+def connection_exists(connection_name):
+    snapshot = get_connections()
+    if not snapshot or connection_name not in snapshot:
         return False
 
+    return snapshot[connection_name].type == 'vpn'
+
 
 def get_interfaces(wifi=True, ethernet=True):
     try:
@@ -147,6 +214,8 @@ def set_global_mac_address(value):
         nm_version = get_version()
 
         if nm_version:
+            from distutils.version import LooseVersion
+
             if LooseVersion(nm_version) >= LooseVersion(MIN_VERSION):
                 mac_config = configparser.ConfigParser(interpolation=None)
 
@@ -316,7 +385,8 @@ def set_ipv6(log=True):
     return utils.run_as_root(main)
 
 
-def set_auto_connect(connection_name):
+def set_auto_connect(connection_name, server_key=None):
+    # server_key is the (country, category, protocol) the connection was chosen for. It's kept in the script, so syncs can move auto-connect to the new best server of that type
     def main():
         interfaces = get_interfaces()
 
@@ -325,6 +395,7 @@ def set_auto_connect(connection_name):
 
             auto_script = (
                 '#!/bin/bash\n\n'
+                '# Server type: ' + json.dumps(list(server_key) if server_key else None) + '\n\n'
                 'if [[ "$1" =~ ' + interface_string +
                 ' ]] && [[ "$2" =~ up|connectivity-change ]]; then\n'
                 '  nmcli con up id "' + connection_name + '" &\n'
@@ -347,6 +418,33 @@ def set_auto_connect(connection_name):
     return utils.run_as_root(main)
 
 
+def get_autoconnect():
+    # Returns (connection name, server key) of the connection auto-connect brings up, or (None, None) if auto-connect isn't set.
+    # The server key is None if auto-connect was set without one, such as by an earlier version
+    try:
+        with open(paths.AUTO_CONNECT_SCRIPT, 'r') as f:
+            script = f.read()
+    except FileNotFoundError:
+        return (None, None)
+    except Exception as ex:
+        logger.error("Could not read the auto-connect script: %s", ex)
+        return (None, None)
+
+    name_match = re.search(r'nmcli con up id "(.*)"', script)
+    if not name_match:
+        return (None, None)
+
+    server_key = None
+    key_match = re.search(r'^# Server type: (.*)$', script, re.MULTILINE)
+    if key_match:
+        try:
+            server_key = tuple(json.loads(key_match.group(1)))
+        except (ValueError, TypeError):
+            pass
+
+    return (name_match.group(1), server_key)
+
+
 def remove_autoconnect():
     def main():
         try:
@@ -390,6 +488,11 @@ def import_connection(file_path,
             os.remove(
                 temp_path)  # Remove the temporary renamed config we created
             output.check_returncode()
+
+            # e.g. "Connection 'us123 [normal] [udp]' (2b5d2c5e-...) successfully added."
+            uuid = re.search(r'\(([0-9a-fA-F-]+)\)', output.stdout.decode('utf-8'))
+            record_connection(connection_name, uuid.group(1) if uuid else None)
+
             return True
         except subprocess.CalledProcessError:
             error = utils.format_std_string(output.stderr)
@@ -491,9 +594,12 @@ def remove_connection(connection_name):
             stderr=subprocess.PIPE)
         output.check_returncode()
 
+        forget_connection(connection_name)
         return True
 
     except subprocess.CalledProcessError:
+        invalidate_connections()  # The snapshot may be out of date
+
         error = utils.format_std_string(output.stderr)
         logger.error(error)
         return False
@@ -1,9 +1,14 @@
-import requests
-from operator import itemgetter
+from nordnm import httpclient
+
+import codecs
+import json
+import sys
+from collections import namedtuple
+from operator import attrgetter
 
 API_ADDR = 'https://api.nordvpn.com'
 OVPN_ADDR = 'https://downloads.nordcdn.com/configs/archives/servers/ovpn.zip'
-TIMEOUT = 5
+CHUNK_SIZE = 64 * 1024  # Bytes read at a time when streaming responses
 
 # 2xx Status codes
 STATUS_OK = 200
@@ -24,6 +29,7 @@ STATUS_REDIRECT = [
     STATUS_MOVED_TEMP,
     STATUS_REDIRECT_PERM,
 ]
+STATUS_NOT_MODIFIED = 304
 
 # Mapping of NordVPN category names to their short internal names
 VPN_CATEGORIES = {
@@ -36,44 +42,129 @@ VPN_CATEGORIES = {
 }
 
 
-def get_server_list(sort_by_load=False, sort_by_country=False):
+# The fields of a /server entry that nordnm uses. categories holds the long category names
+Server = namedtuple('Server', ['domain', 'ip_address', 'load', 'flag', 'country', 'categories', 'openvpn_udp', 'openvpn_tcp'])
+
+
+def get_server_data(etag=None, last_modified=None):
+    """
+    Requests the raw /server JSON, unless it hasn't changed since the given validators.
+    Returns (chunks, etag, last_modified), where chunks lazily streams the body,
+    (None, None, None) if not modified, or False on failure.
+    """
+
     try:
-        resp = requests.get(API_ADDR + '/server', timeout=TIMEOUT)
-        if resp.status_code in STATUS_SUCCESS:
-            server_list = resp.json()
-
-            if sort_by_load:
-                return sorted(server_list, key=itemgetter('load'))
-            elif sort_by_country:
-                return sorted(server_list, key=itemgetter('country'))
-            else:
-                return server_list
+        resp = httpclient.conditional_get(API_ADDR + '/server', etag, last_modified, stream=True)
+        if resp.status_code == STATUS_NOT_MODIFIED:
+            resp.close()
+            return (None, None, None)
+        elif resp.status_code in STATUS_SUCCESS:
+            return (resp.iter_content(CHUNK_SIZE), resp.headers.get('etag'), resp.headers.get('last-modified'))
         else:
-            return None
+            resp.close()
+            return False
     except Exception:
+        return False
+
+
+def make_server(entry):
+    # Strings repeated across thousands of servers are interned, so each is only stored once
+    features = entry.get('features', {})
+    categories = tuple(sys.intern(category['name']) for category in entry.get('categories', []))
+
+    return Server(entry['domain'], entry['ip_address'], entry['load'], sys.intern(entry['flag']), sys.intern(entry['country']),
+                  categories, bool(features.get('openvpn_udp')), bool(features.get('openvpn_tcp')))
+
+
+def iter_servers(chunks):
+    """
+    Incrementally parses a /server JSON array from an iterable of byte chunks, yielding a Server per entry.
+    Only one entry is ever fully decoded at a time, so the complete response is never held in memory.
+    Raises ValueError if the JSON is malformed or ends early.
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+
+            if position == len(buffer):
+                break
+
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a JSON array of servers")
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                entry, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                break  # The entry continues in the next chunk
+
+            try:
+                server = make_server(entry)
+            except (KeyError, TypeError, AttributeError) as ex:
+                raise ValueError("Unexpected server list entry (%r)" % ex)
+
+            yield server
+
+    raise ValueError("The server list ended unexpectedly")
+
+
+def sort_server_list(server_list, sort_by_load=False, sort_by_country=False):
+    if sort_by_load:
+        return sorted(server_list, key=attrgetter('load'))
+    elif sort_by_country:
+        return sorted(server_list, key=attrgetter('country'))
+    else:
+        return server_list
+
+
+def get_server_list(sort_by_load=False, sort_by_country=False, server_cache=None):
+    # With a ServerCache, the catalog is only downloaded when the snapshot is too old and has changed
+    if server_cache:
+        server_list = server_cache.get_server_list()
+    else:
+        server_list = None
+        server_data = get_server_data()
+        if server_data:
+            try:
+                server_list = list(iter_servers(server_data[0]))
+            except Exception:
+                pass
+
+    if server_list is None:
         return None
 
+    return sort_server_list(server_list, sort_by_load, sort_by_country)
+
+
+def get_configs(path, etag=None):
+    """
+    Downloads the OpenVPN configuration archive to path, unless its ETag still matches etag.
+    Returns (path, etag), (None, None) if not modified, or False on failure.
+    """
 
-def get_configs(etag=None):
     try:
-        head = requests.head(OVPN_ADDR, timeout=TIMEOUT)
-
-        # Follow the redirect if there is one
-        if head.status_code in STATUS_REDIRECT:
-            redirect_url = head.headers['Location']
-            head = requests.head(redirect_url, timeout=TIMEOUT)
-
-        if head.status_code in STATUS_SUCCESS:
-            header_etag = head.headers['etag']
-
-            if header_etag != etag:
-                resp = requests.get(OVPN_ADDR, timeout=TIMEOUT)
-                if resp.status_code in STATUS_SUCCESS:
-                    return (resp.content, header_etag)
-            else:
-                return (None, None)
-        else:
-            return False
+        new_etag = httpclient.download(OVPN_ADDR, path, etag)
+        if new_etag is None:
+            return (None, None)
+
+        return (path, new_etag)
     except Exception as ex:
         print(ex)
         return False
@@ -96,9 +187,8 @@ def get_user_token(email, password):
     json_data = {'username': email, 'password': password}
 
     try:
-        resp = requests.post(API_ADDR + '/v1/users/tokens',
-                             json=json_data,
-                             timeout=TIMEOUT)
+        resp = httpclient.request('POST', API_ADDR + '/v1/users/tokens',
+                                  json=json_data)
         if resp.status_code in STATUS_SUCCESS:
             return resp.content
         else:
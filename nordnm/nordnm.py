@@ -1,39 +1,37 @@
 from nordnm.credentials import CredentialsHandler
 from nordnm.settings import SettingsHandler
+from nordnm.probecache import ProbeCache
+from nordnm.servercache import ServerCache
+from nordnm import configarchive
 from nordnm import nordapi
+from nordnm import httpclient
 from nordnm import networkmanager
 from nordnm import utils
-from nordnm import benchmarking
 from nordnm import paths
+from nordnm import scoring
+from nordnm import syncplan
+from nordnm import daemon
+from nordnm.statestore import StateStore
 from nordnm.__init__ import __version__
 
 import argparse
 import os
 import shutil
-import pickle
 import sys
-import glob
 import logging
-import copy
+import time
 from timeit import default_timer as timer
-from distutils.version import StrictVersion
 
-
-IMPORTED_SERVER_KEY = ('(imported)', '', '')
+# numpy and the modules built on it (benchmarking, servercatalog) are only imported by the commands that use them, to keep start-up fast
 
 
-def generate_connection_name(server, protocol):
-    short_name = server['domain'].split('.')[0]
-    connection_name = short_name + ' ['
+IMPORTED_SERVER_KEY = ('(imported)', '', '')
 
-    for i, category in enumerate(server['categories']):
-        category_name = nordapi.VPN_CATEGORIES[category['name']]
-        if i > 0:  # prepend a separator if there is more than one category
-            category_name = '|' + category_name
 
-        connection_name = connection_name + category_name
+def is_newer_version(version, current_version):
+    from distutils.version import StrictVersion  # Slow to import, so only when there's something to compare
 
-    return connection_name + '] [' + protocol + ']'
+    return StrictVersion(current_version) < StrictVersion(version)
 
 
 class NordNM(object):
@@ -67,12 +65,16 @@ class NordNM(object):
         list_parser.add_argument('--active-servers', help='Display a list of the active servers currently synchronised.', action='store_true', default=False)
         list_parser.add_argument('--countries', help='Display a list of the available NordVPN countries.', action='store_true', default=False)
         list_parser.add_argument('--categories', help='Display a list of the available NordVPN categories..', action='store_true', default=False)
+        list_parser.add_argument('--scores', help='Display how the score of each active server breaks down, using the current scoring settings.', action='store_true', default=False)
+        list_parser.add_argument('--history', help='Display a summary of the most recent synchronisations.', action='store_true', default=False)
         list_parser.set_defaults(list=True)
 
         sync_parser = subparsers.add_parser('sync', aliases=['s'], help="Synchronise the optimal servers (based on load and latency) to NetworkManager.")
-        sync_parser.add_argument('-s', '--slow-mode', help="Run benchmarking in 'slow mode'. May increase benchmarking success by pinging servers at a slower rate.", action='store_true')
+        sync_parser.add_argument('-s', '--slow-mode', help="Run benchmarking in 'slow mode'. May increase benchmarking success by pinging servers at a slower rate, one at a time.", action='store_true')
         sync_parser.add_argument('-p', '--preserve-vpn', help="When provided, synchronising will preserve any active VPN instead of disabling it for more accurate benchmarking.", action='store_true')
+        sync_parser.add_argument('-t', '--time-budget', type=float, metavar='SECONDS', help="Stop benchmarking once this many seconds have passed since the sync started, and use the best servers found so far. Probes the servers most likely to be the best first.")
         sync_parser.add_argument('-n', '--no-update', help='Do not download the latest OpenVPN configurations from NordVPN.', action='store_true', default=False)
+        sync_parser.add_argument('--http-timings', help='Display how long each request to NordVPN took, and how many attempts it needed.', action='store_true', default=False)
         sync_parser.add_argument("-k", "--kill-switch", help="Sets a network kill-switch, to disable the active network interface when an active VPN connection disconnects.", action="store_true")
         sync_parser.add_argument("-i", "--disable-ipv6", help="Disable IPv6 when enabling a VPN connection", action="store_true")
         sync_parser.add_argument('-a', '--auto-connect', nargs=3, metavar=('[COUNTRY_CODE]', '[VPN_CATEGORY]', '[PROTOCOL]'), help='Configure NetworkManager to auto-connect to the chosen server type. Takes country code, category and protocol.')
@@ -87,6 +89,15 @@ class NordNM(object):
         import_parser.add_argument('-p', '--password', required=True, help="Specify the password used for the OpenVPN config.", metavar="PASSWORD")
         import_parser.set_defaults(import_config=True)
 
+        connect_parser = subparsers.add_parser('connect', aliases=['c'], help="Connect to one of the synchronised servers.")
+        connect_parser.add_argument('server', nargs=3, metavar=('COUNTRY_CODE', 'VPN_CATEGORY', 'PROTOCOL'), help="The type of server to connect to. Takes country code, category and protocol.")
+        connect_parser.set_defaults(connect=True)
+
+        daemon_parser = subparsers.add_parser('daemon', aliases=['d'], help="Keep running in the background, re-synchronising on a schedule. Other nordnm commands are passed to the daemon while it runs.")
+        daemon_parser.add_argument('--interval', type=int, metavar='SECONDS', default=daemon.DEFAULT_INTERVAL, help="Seconds between scheduled synchronisations (default: %(default)s). These are skipped while a VPN is connected.")
+        daemon_parser.add_argument('-t', '--time-budget', type=float, metavar='SECONDS', help="Stop the benchmarking of scheduled synchronisations after this many seconds.")
+        daemon_parser.set_defaults(daemon=True)
+
         # For reference: https://blogs.gnome.org/thaller/category/networkmanager/
         mac_parser = subparsers.add_parser('mac', aliases=['m'], help="Global NetworkManager MAC address preferences. This command will affect ALL NetworkManager connections permanently.")
         mac_parser.add_argument('-r', '--random', help="A randomised MAC addresss will be generated on each connect.", action='store_true')
@@ -98,6 +109,12 @@ class NordNM(object):
 
         self.logger = logging.getLogger(__name__)
         self.active_servers = {}
+        self.state_store = None
+        self.server_filter = None
+        self.server_cache = None
+        self.probe_cache = None
+        self.config_archive = None
+        self.changed_config_domains = set()  # Domains whose configs changed since their connections were last imported
 
         try:
             args = parser.parse_args()
@@ -155,8 +172,7 @@ class NordNM(object):
 
             if args.remove_c:
                 # Get the active servers, since self.setup() hasn't run
-                if os.path.isfile(paths.ACTIVE_SERVERS):
-                    self.active_servers = self.load_active_servers(paths.ACTIVE_SERVERS)
+                self.active_servers = self.load_active_servers()
 
                 if self.remove_active_connections():
                     removed = True
@@ -176,16 +192,21 @@ class NordNM(object):
 
             sys.exit(0)
         elif "list" in args and args.list:
-            if not args.countries and not args.categories and not args.active_servers:
+            if not args.countries and not args.categories and not args.active_servers and not args.scores and not args.history:
                 list_parser.print_help()
                 sys.exit(1)
 
+            # Always answered here rather than by a daemon, which may be busy with a sync. It only reads local data, which the daemon saves as it goes
             if args.categories:
                 self.print_categories()
             if args.countries:
                 self.print_countries()
             if args.active_servers:
                 self.print_active_servers()
+            if args.scores:
+                self.print_score_breakdown()
+            if args.history:
+                self.print_sync_history()
 
             sys.exit(0)
         elif "mac" in args and args.mac:
@@ -222,10 +243,34 @@ class NordNM(object):
 
             sys.exit(0)
 
+        if "daemon" in args and args.daemon:
+            if not daemon.Daemon(self, args.interval, args.time_budget).serve():
+                sys.exit(1)
+
+            sys.exit(0)
+
+        if "connect" in args and args.connect:
+            status = self.forward_to_daemon({'command': 'connect', 'server': args.server})
+            if status is None:
+                status = 0 if self.connect(*args.server) else 1
+
+            sys.exit(status)
+
         # Now check for commands that can be chained...
         if "sync" in args and args.sync:
             # Take the inverse of no_update arg as update parameter
-            self.sync(not args.no_update, args.preserve_vpn, args.slow_mode)
+            request = {'command': 'sync', 'update_config': not args.no_update, 'preserve_vpn': args.preserve_vpn, 'slow_mode': args.slow_mode, 'time_budget': args.time_budget, 'http_timings': args.http_timings}
+            status = self.forward_to_daemon(request)
+            if status is None:
+                try:
+                    self.sync(not args.no_update, args.preserve_vpn, args.slow_mode, args.time_budget)
+                finally:
+                    if args.http_timings:
+                        self.print_http_timings()  # Most useful when the sync failed
+            elif status == 0:
+                self.active_servers = self.load_active_servers()  # Synchronised by the daemon
+            else:
+                sys.exit(status)
 
         if "import_config" in args and args.import_config:
             if not self.import_config(args.config_file, args.username, args.password):
@@ -252,9 +297,9 @@ class NordNM(object):
     def print_splash(self):
         version_string = __version__
 
-        latest_version = utils.get_pypi_package_version(__package__)
+        latest_version = utils.get_latest_version(paths.VERSION_CACHE)
         if latest_version:
-            if StrictVersion(version_string) < StrictVersion(latest_version):  # There's a new version on PyPi
+            if latest_version != version_string and is_newer_version(latest_version, version_string):  # There's a new version on PyPi
                 version_string = version_string + " (v" + latest_version + " available!)"
             else:
                 version_string = version_string + " (Latest)"
@@ -278,7 +323,7 @@ class NordNM(object):
         print()  # For spacing
 
     def print_countries(self):
-        servers = nordapi.get_server_list(sort_by_country=True)
+        servers = nordapi.get_server_list(sort_by_country=True, server_cache=self.get_server_cache())
         if servers:
             format_string = "| %-22s | %-4s |"
             countries = []
@@ -288,19 +333,48 @@ class NordNM(object):
             print("|------------------------+------|")
 
             for server in servers:
-                country_code = server['flag']
+                country_code = server.flag
                 if country_code not in countries:
                     countries.append(country_code)
-                    country_name = server['country']
+                    country_name = server.country
                     print(format_string % (country_name, country_code))
 
             print()  # For spacing
         else:
             self.logger.error("Could not get available countries from the NordVPN API.")
 
+    def forward_to_daemon(self, request):
+        # Returns the exit status of the request, if a running daemon handled it. Otherwise None, and the command should be run here
+        reply = daemon.send_request(request)
+        if reply is None:
+            return None
+
+        sys.stdout.write(reply['output'])
+        return reply['status']
+
+    def get_server_cache(self):
+        # Listing countries can happen before setup(), so the settings may not be loaded (or even exist) yet
+        max_age = SettingsHandler.DEFAULT_SERVER_LIST_MAX_AGE
+        if hasattr(self, 'settings'):
+            max_age = self.settings.get_server_list_max_age()
+        elif os.path.isfile(paths.SETTINGS):
+            max_age = SettingsHandler(paths.SETTINGS).get_server_list_max_age()
+
+        # Kept, so a long-running instance (the daemon) keeps the parsed server list in memory
+        if self.server_cache is None or self.server_cache.max_age != max_age:
+            self.server_cache = ServerCache(paths.SERVER_CACHE, max_age)
+
+        return self.server_cache
+
+    def get_probe_cache(self):
+        ttl = self.settings.get_cache_ttl()
+        if self.probe_cache is None or self.probe_cache.ttl != ttl:
+            self.probe_cache = ProbeCache(paths.PROBE_CACHE, ttl)
+
+        return self.probe_cache
+
     def print_active_servers(self):
-        if os.path.isfile(paths.ACTIVE_SERVERS):
-            self.active_servers = self.load_active_servers(paths.ACTIVE_SERVERS)
+        self.active_servers = self.load_active_servers()
 
         if self.active_servers:
             print("Note: All metrics below are from the last synchronise.\n")
@@ -321,17 +395,93 @@ class NordNM(object):
         else:
             self.logger.warning("No active servers to display.")
 
+    def print_score_breakdown(self):
+        self.active_servers = self.load_active_servers()
+
+        # Ignore servers which weren't benchmarked, such as imported configs
+        keys = [key for key in self.active_servers if self.active_servers[key]['latency'] > 0] if self.active_servers else []
+        if not keys:
+            self.logger.warning("No active servers to display.")
+            return
+
+        weights = scoring.DEFAULT_WEIGHTS
+        if os.path.isfile(paths.SETTINGS):
+            weights = SettingsHandler(paths.SETTINGS).get_score_weights()
+
+        import numpy
+        from nordnm import benchmarking
+
+        # Servers synchronised before p95 and jitter were measured are scored on their mean RTT alone
+        servers = [self.active_servers[key] for key in keys]
+        loads = numpy.array([server['load'] for server in servers], dtype=float)
+        rtts = numpy.array([server['latency'] for server in servers], dtype=float)
+        p95s = numpy.array([server.get('p95', numpy.nan) for server in servers], dtype=float)
+        jitters = numpy.array([server.get('jitter', numpy.nan) for server in servers], dtype=float)
+        losses = numpy.array([server.get('loss', 0) for server in servers], dtype=float)
+
+        components = scoring.get_score_components(weights, loads, rtts, p95s, jitters, losses)
+        scores = scoring.get_scores(weights, loads, rtts, p95s, jitters, losses, benchmarking.MAX_LOAD)
+
+        print("Note: Metrics are from the last synchronise. Scores are recalculated with the current scoring settings.")
+        print("      SCORE = exp(-(LOAD x (RTT + P95 + JITTER) + LOSS) / %s)\n" % weights.sensitivity)
+        format_string = "| %-16s | %-20s | %-6s | %-8s | %-8s | %-8s | %-8s | %-6s |"
+        print(format_string % ("PARAMETER", "SERVER", "LOAD", "RTT", "P95", "JITTER", "LOSS", "SCORE"))
+        print("|------------------+----------------------+--------+----------+----------+----------+----------+--------|")
+
+        for i, key in enumerate(keys):
+            parameters = ' '.join(key).lower()
+            values = [components[component][i] for component in ('load_factor', 'rtt', 'p95', 'jitter', 'loss')]
+
+            print(format_string % ((parameters, servers[i]['domain']) + tuple(round(value, 2) for value in values) + (scores[i],)))
+
+        print()  # For spacing
+
+    def print_sync_history(self):
+        history = self.get_state_store().get_sync_history()
+        if not history:
+            self.logger.warning("No synchronisations to display.")
+            return
+
+        format_string = "| %-19s | %-12s | %-8s | %-11s | %-8s | %-8s |"
+        print(format_string % ("TIME", "DURATION (s)", "SERVERS", "SUCCESS (%)", "COMPLETE", "WINNERS"))
+        print("|---------------------+--------------+----------+-------------+----------+----------|")
+
+        for sync_id, sync_time, duration, num_servers, num_success, complete, num_winners in history:
+            sync_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sync_time))
+            percent_success = round(num_success / num_servers * 100, 2) if num_servers else 0
+
+            print(format_string % (sync_time, round(duration, 2), num_servers, percent_success, 'yes' if complete else 'no', num_winners))
+
+        print()  # For spacing
+
+    def print_http_timings(self):
+        timings = httpclient.get_timings()
+        if not timings:
+            self.logger.warning("No requests to display.")
+            return
+
+        format_string = "| %-6s | %-60s | %-6s | %-8s | %-8s |"
+        print(format_string % ("METHOD", "URL", "STATUS", "ATTEMPTS", "TIME (s)"))
+        print("|--------+--------------------------------------------------------------+--------+----------+----------|")
+
+        for method, url, status, attempts, elapsed in timings:
+            print(format_string % (method, url[:60], status or 'failed', attempts, round(elapsed, 3)))
+
+        print()  # For spacing
+
     def setup(self):
         self.create_directories()
 
         self.settings = SettingsHandler(paths.SETTINGS)
+        httpclient.configure(self.settings.get_connect_timeout(), self.settings.get_read_timeout(), self.settings.get_retries())
+
         self.credentials = CredentialsHandler(paths.CREDENTIALS)
 
         self.black_list = self.settings.get_blacklist()
         self.white_list = self.settings.get_whitelist()
+        self.server_filter = None
 
-        if os.path.isfile(paths.ACTIVE_SERVERS):
-            self.active_servers = self.load_active_servers(paths.ACTIVE_SERVERS)
+        self.active_servers = self.load_active_servers()
 
     def remove_legacy_files(self):
         removed = False
@@ -380,20 +530,43 @@ class NordNM(object):
         return utils.run_as_root(main)
 
     def get_configs(self):
-        self.logger.info("Downloading latest NordVPN OpenVPN configuration files to '%s'." % paths.OVPN_CONFIGS)
+        self.logger.info("Downloading latest NordVPN OpenVPN configuration files to '%s'." % paths.OVPN_ARCHIVE)
 
         etag = self.get_config_info()
-        config_data = nordapi.get_configs(etag)
+        if not os.path.isfile(paths.OVPN_ARCHIVE):
+            etag = None
+
+        old_manifest = configarchive.load_manifest(paths.CONFIG_MANIFEST)
+
+        config_data = nordapi.get_configs(paths.OVPN_ARCHIVE, etag)
         if config_data is False:
             self.logger.error("Failed to retrieve configuration files from NordVPN")
             return False
         elif config_data:
-            zip_file, etag = config_data
-            if zip_file and etag:
-                self.delete_configs()
+            zip_path, etag = config_data
+            if zip_path and etag:
+                if self.config_archive:
+                    self.config_archive.close()
+                self.config_archive = None
+                config_archive = self.get_config_archive()
 
-                if not utils.extract_zip(zip_file, paths.OVPN_CONFIGS):
-                    self.logger.error("Failed to extract configuration files")
+                try:
+                    if old_manifest is None:
+                        # Nothing to tell which of the configs already extracted are stale, so remove them all. They are extracted again as they are needed
+                        self.delete_configs()
+                        config_archive.load_index()
+
+                        # Nor which connections were imported from stale configs, so every active server is imported again
+                        self.changed_config_domains |= set(server['domain'] for server in self.load_active_servers().values())
+                    else:
+                        changed_domains = config_archive.update(old_manifest)
+                        self.changed_config_domains |= changed_domains
+                        self.logger.info("%i servers have new or changed configuration files.", len(changed_domains))
+                except Exception as ex:
+                    self.logger.error("Failed to read configuration files: %s" % ex)
+                    return False
+
+                if not configarchive.save_manifest(config_archive.manifest, paths.CONFIG_MANIFEST):
                     return False
 
                 if not self.set_config_info(etag):
@@ -403,16 +576,30 @@ class NordNM(object):
 
             return True
 
-    def sync(self, update_config=True, preserve_vpn=False, slow_mode=False):
+    def get_config_archive(self):
+        if self.config_archive is None:
+            self.config_archive = configarchive.ConfigArchive(paths.OVPN_ARCHIVE, paths.OVPN_CONFIGS, paths.CONFIG_INDEX)
+
+        return self.config_archive
+
+    def sync(self, update_config=True, preserve_vpn=False, slow_mode=False, time_budget=None):
+        deadline = None
+        if time_budget is not None:
+            deadline = timer() + time_budget
+
         if self.remove_legacy_files():
             self.logger.info("Removed legacy files")
 
+        httpclient.clear_timings()  # So only this sync's requests are reported
+
         if update_config:
             self.get_configs()
 
-        if self.sync_servers(preserve_vpn, slow_mode):
+        if self.sync_servers(preserve_vpn, slow_mode, deadline):
             networkmanager.reload_connections()
 
+        utils.update_version_cache(__package__, paths.VERSION_CACHE)
+
     def import_config(self, file_path: str, username: str, password: str) -> bool:
         updated = False
         imported = False
@@ -435,14 +622,13 @@ class NordNM(object):
         if networkmanager.import_connection(file_path, connection_name, username, password, dns_list):
             updated = True
             imported = True
-            self.active_servers[IMPORTED_SERVER_KEY] = {
+            self.set_active_server(IMPORTED_SERVER_KEY, {
                 'name': connection_name,
                 'domain': '<' + connection_name + '>',
                 'score': -1,
                 'load': -1,
                 'latency': -1,
-            }
-            self.save_active_servers(self.active_servers, paths.ACTIVE_SERVERS)
+            })
 
         if updated:
             networkmanager.reload_connections()
@@ -473,12 +659,10 @@ class NordNM(object):
         ovpn_path = None
 
         try:
-            files = glob.glob(paths.OVPN_CONFIGS + '/**/' + domain + '.' + protocol + '*.ovpn')
+            ovpn_path = self.get_config_archive().get_config_path(domain, protocol)
 
-            if not files:
+            if not ovpn_path:
                 return False
-
-            ovpn_path = files[0]
         except Exception as ex:
             self.logger.error(ex)
 
@@ -493,119 +677,101 @@ class NordNM(object):
             connection_load = self.active_servers[selected_parameters]['load']
             connection_latency = self.active_servers[selected_parameters]['latency']
 
-            if networkmanager.set_auto_connect(connection_name):
+            if networkmanager.set_auto_connect(connection_name, selected_parameters):
                 self.logger.info("Auto-connect enabled for '%s' (Load: %i%%, Latency: %0.2fs).", connection_name, connection_load, connection_latency)
 
-                # Temporarily remove the kill-switch if there was one
-                kill_switch = networkmanager.remove_killswitch(log=False)
+                if self.switch_connection(connection_name):
+                    enabled = True
+        else:
+            self.logger.error("Auto-connect not activated: No active server found matching [%s, %s, %s].", country_code, category, protocol)
 
-                disable_ipv6 = networkmanager.remove_ipv6(log=False)
+        return enabled
 
-                networkmanager.disconnect_active_vpn(self.active_servers)
+    def connect(self, country_code, category, protocol):
+        selected_parameters = (country_code.lower(), category.lower(), protocol.lower())
 
-                if kill_switch:
-                    networkmanager.set_killswitch(log=False)
+        if selected_parameters not in self.active_servers:
+            self.logger.error("Not connected: No active server found matching [%s, %s, %s].", country_code, category, protocol)
+            return False
 
-                if disable_ipv6:
-                    networkmanager.set_ipv6(log=False)
+        connection_name = self.active_servers[selected_parameters]['name']
+        if not self.switch_connection(connection_name):
+            return False
 
-                if networkmanager.enable_connection(connection_name):
-                    enabled = True
-        else:
-            self.logger.error("Auto-connect not activated: No active server found matching [%s, %s, %s].", country_code, category, protocol)
+        self.logger.info("Connected to '%s'.", connection_name)
+        return True
 
-        return enabled
+    def switch_connection(self, connection_name):
+        # Disconnect any active VPN and bring up connection_name instead
+        # Temporarily remove the kill-switch if there was one
+        kill_switch = networkmanager.remove_killswitch(log=False)
+
+        disable_ipv6 = networkmanager.remove_ipv6(log=False)
+
+        networkmanager.disconnect_active_vpn(self.active_servers)
+
+        if kill_switch:
+            networkmanager.set_killswitch(log=False)
+
+        if disable_ipv6:
+            networkmanager.set_ipv6(log=False)
+
+        return networkmanager.enable_connection(connection_name)
 
     def remove_active_connections(self):
         if self.active_servers:
             self.logger.info("Removing all active connections...")
-            active_servers = copy.deepcopy(self.active_servers)
-            for key in self.active_servers.keys():
+            for key in list(self.active_servers.keys()):
                 connection_name = self.active_servers[key]['name']
                 if self.connection_exists(connection_name):
                     networkmanager.remove_connection(connection_name)
 
-                del active_servers[key]
-                self.save_active_servers(active_servers, paths.ACTIVE_SERVERS)  # Save after every successful removal, in case importer is killed abruptly
-
-            self.active_servers = active_servers
+                self.remove_active_server(key)  # Saved after every successful removal, in case importer is killed abruptly
 
             return True
         else:
             self.logger.info("No active connections to remove.")
 
-    def load_active_servers(self, path):
-        try:
-            with open(paths.ACTIVE_SERVERS, 'rb') as fp:
-                active_servers = pickle.load(fp)
-            return active_servers
-        except Exception as ex:
-            self.logger.error(ex)
-            return None
+    def get_state_store(self):
+        if self.state_store is None:
+            self.state_store = StateStore(paths.STATE, paths.ACTIVE_SERVERS)
 
-    def save_active_servers(self, active_servers, path):
-        try:
-            with open(paths.ACTIVE_SERVERS, 'wb') as fp:
-                pickle.dump(active_servers, fp)
+        return self.state_store
 
-        except Exception as ex:
-            self.logger.error(ex)
+    def load_active_servers(self):
+        return self.get_state_store().load()
 
-    def country_is_selected(self, country_code):
-        # If (there is a whitelist and the country code is whitelisted) or (there is no whitelist, but there is a blacklist and it's not in the blacklist) or (there is no whitelist or blacklist)
-        if (self.white_list and country_code in self.white_list) or (not self.white_list and self.black_list and country_code not in self.black_list) or (not self.white_list and not self.black_list):
-            return True
-        else:
-            return False
+    def set_active_server(self, key, server):
+        self.active_servers[key] = server
+        self.get_state_store().set(key, server)
 
-    def has_valid_categories(self, server):
-        valid_categories = self.settings.get_categories()
+    def remove_active_server(self, key):
+        del self.active_servers[key]
+        self.get_state_store().remove(key)
 
-        # If the server has a category that is valid, return true
-        for category in server['categories']:
-            if category['name'] in valid_categories:
-                return True
+    def get_server_filter(self):
+        # The settings are only read once, however many servers are filtered
+        if self.server_filter is None:
+            from nordnm.servercatalog import ServerFilter
 
-        return False
+            self.server_filter = ServerFilter(self.settings.get_protocols(), self.settings.get_categories(), self.white_list, self.black_list)
 
-    def has_valid_protocol(self, server):
-        valid_protocols = self.settings.get_protocols()
-        has_openvpn_tcp = server['features']['openvpn_tcp']
-        has_openvpn_udp = server['features']['openvpn_udp']
+        return self.server_filter
 
-        if ('tcp' in valid_protocols and has_openvpn_tcp) or ('udp' in valid_protocols and has_openvpn_udp):
-            return True
-        else:
-            return False
-
-    def get_valid_servers(self, servers):
-        valid_server_list = []
-
-        for server in servers:
-            country_code = server['flag'].lower()
-
-            # If the server country has been selected, it has a selected protocol and selected categories
-            if self.country_is_selected(country_code) and self.has_valid_protocol(server) and self.has_valid_categories(server):
-                valid_server_list.append(server)
-
-        return valid_server_list
+    def get_valid_servers(self, catalog):
+        # Keep servers whose country has been selected, that have a selected protocol and selected categories
+        return catalog.subset(self.get_server_filter().select(catalog))
 
     def connection_exists(self, connection_name):
-        vpn_connections = networkmanager.get_vpn_connections()
-
-        if vpn_connections and connection_name in vpn_connections:
-            return True
-        else:
-            return False
+        return networkmanager.connection_exists(connection_name)
 
     def configs_exist(self):
-        configs = os.listdir(paths.OVPN_CONFIGS)
-        if configs:
-            return True
-        else:
-            return False
+        return os.path.isfile(paths.OVPN_ARCHIVE)
+
+    def sync_servers(self, preserve_vpn, slow_mode, deadline=None):
+        from nordnm import benchmarking
+        from nordnm.servercatalog import ServerCatalog
 
-    def sync_servers(self, preserve_vpn, slow_mode):
         updated = False
 
         username = self.credentials.get_username()
@@ -621,11 +787,11 @@ class NordNM(object):
 
         self.logger.info("Checking for new connections to import...")
 
-        server_list = nordapi.get_server_list(sort_by_load=True)
+        server_list = nordapi.get_server_list(sort_by_load=True, server_cache=self.get_server_cache())
         if server_list:
 
-            valid_server_list = self.get_valid_servers(server_list)
-            if valid_server_list:
+            valid_servers = self.get_valid_servers(ServerCatalog(server_list))
+            if len(valid_servers):
 
                 if not preserve_vpn:
                     # If there's a kill-switch in place, we need to temporarily remove it, otherwise it will kill out network when disabling an active VPN below
@@ -646,40 +812,77 @@ class NordNM(object):
                 else:
                     self.logger.warning("Active VPN preserved. This may give unreliable results!")
 
+                budget = benchmarking.ProbeBudget(self.settings.get_probe_rate(), self.settings.get_probe_burst(), self.settings.get_loss_threshold())
                 if slow_mode:
+                    budget = benchmarking.get_slow_budget(budget)
                     self.logger.info("Benchmarking slow mode enabled.")
 
-                num_servers = len(valid_server_list)
+                num_servers = len(valid_servers)
                 self.logger.info("Benchmarking %i servers...", num_servers)
 
                 start = timer()
                 ping_attempts = self.settings.get_ping_attempts()  # We are going to be multiprocessing within a class instance, so this needs getting outside of the multiprocessing
                 valid_protocols = self.settings.get_protocols()
                 valid_categories = self.settings.get_categories()
-                best_servers, num_success = benchmarking.get_best_servers(valid_server_list, ping_attempts, valid_protocols, valid_categories, slow_mode)
+                refine_candidates = self.settings.get_refine_candidates()
+                probe_cache = self.get_probe_cache()
+                weights = self.settings.get_score_weights()
+                benchmark = benchmarking.Benchmark(valid_servers, ping_attempts, valid_protocols, valid_categories, budget, refine_candidates, probe_cache, weights)
+                best_servers, num_success = benchmark.run(deadline)
+                probe_cache.save()
 
                 end = timer()
 
                 if num_success == 0:
-                    self.logger.error("Benchmarking failed to test any servers. Your network may be blocking large-scale ICMP requests. Exiting.")
+                    if benchmark.complete:
+                        self.logger.error("Benchmarking failed to test any servers. Your network may be blocking large-scale ICMP requests. Exiting.")
+                    else:
+                        self.logger.error("Benchmarking stopped before any servers were tested successfully. Exiting.")
                     sys.exit(1)
                 else:
                     percent_success = round(num_success / num_servers * 100, 2)
                     self.logger.info("Benchmarked %i servers successfully (%0.2f%%). Took %0.2f seconds.", num_success, percent_success, end - start)
 
-                    if percent_success < 90.0:
-                        self.logger.warning("A large quantity of tests failed. Your network may be unreliable, or blocking large-scale ICMP requests. Syncing in slow mode (-s) may fix this.")
+                    if percent_success < 90.0 and benchmark.complete:
+                        self.logger.warning("A large quantity of tests failed. Your network may be unreliable, or blocking large-scale ICMP requests. Lowering probe-rate in '%s' or syncing in slow mode (-s) may fix this.", paths.SETTINGS)
+
+                partial_buckets = {}
+                if not benchmark.complete:
+                    partial_buckets = benchmark.get_partial_buckets()
+                    if partial_buckets:
+                        self.logger.warning("Not every server was benchmarked in time. %i server types were only partially covered:", len(partial_buckets))
+
+                        for key in sorted(partial_buckets):
+                            num_probed, num_servers = partial_buckets[key]
+                            if key in best_servers:
+                                self.logger.info("%s %s [%s]: %i/%i servers benchmarked.", key[0].upper(), key[1], key[2], num_probed, num_servers)
+                            elif key in self.active_servers:
+                                self.logger.info("%s %s [%s]: %i/%i servers benchmarked, none successfully. The existing connection will be kept.", key[0].upper(), key[1], key[2], num_probed, num_servers)
+                            else:
+                                self.logger.info("%s %s [%s]: %i/%i servers benchmarked, none successfully. No connection will be added.", key[0].upper(), key[1], key[2], num_probed, num_servers)
 
-                # remove all old connections and any auto-connect, until a better sync routine is added
-                if self.remove_active_connections():
-                    updated = True
-                if networkmanager.remove_autoconnect():
-                    updated = True
+                # Only touch the connections of server types whose best server changed
+                plan = syncplan.get_sync_plan(self.active_servers, best_servers, self.changed_config_domains, partial_buckets)
+                self.logger.info("%i connections unchanged, %i to add, %i to update and %i to remove.", len(plan.keep), len(plan.add), len(plan.update), len(plan.remove))
+
+                obsolete_connections = syncplan.get_obsolete_connections(self.active_servers, best_servers, plan)
+                autoconnect_name, autoconnect_key = networkmanager.get_autoconnect()
+
+                for name in obsolete_connections:
+                    if self.connection_exists(name):
+                        networkmanager.remove_connection(name)
+                        updated = True
+
+                for key in plan.remove:
+                    self.remove_active_server(key)  # Saved after every change, in case the importer is killed abruptly
 
                 self.logger.info("Adding new connections...")
 
                 new_connections = 0
-                for key in best_servers.keys():
+                for key in plan.keep + plan.add + plan.update:
+                    if key not in best_servers:
+                        continue  # Kept from a previous sync, as this sync didn't find a replacement
+
                     imported = True
                     name = best_servers[key]['name']
 
@@ -695,12 +898,31 @@ class NordNM(object):
                             else:
                                 imported = False
                         else:
+                            imported = False
                             self.logger.warning("Could not find a configuration file for %s. Skipping.", name)
 
                     # If the connection already existed, or the import was successful, add the server combination to the active servers
                     if imported:
-                        self.active_servers[key] = best_servers[key]
-                        self.save_active_servers(self.active_servers, paths.ACTIVE_SERVERS)
+                        self.set_active_server(key, best_servers[key])
+                    elif key in self.active_servers:
+                        self.remove_active_server(key)
+
+                # Keep auto-connect on the best server of the type it was set for
+                if autoconnect_name:
+                    autoconnect_server = self.active_servers.get(autoconnect_key) if autoconnect_key else None
+                    if autoconnect_server and autoconnect_server['name'] != autoconnect_name:
+                        if networkmanager.set_auto_connect(autoconnect_server['name'], autoconnect_key):
+                            self.logger.info("Auto-connect moved to '%s'.", autoconnect_server['name'])
+                            updated = True
+                    elif autoconnect_name in obsolete_connections and not self.connection_exists(autoconnect_name):
+                        if networkmanager.remove_autoconnect():
+                            updated = True
+
+                # Every connection from a changed config has now been imported again, except those kept from unfinished buckets
+                self.changed_config_domains &= set(self.active_servers[key]['domain'] for key in plan.keep if key not in best_servers)
+
+                probe_results = {domain: benchmark.coarse_results[host] for domain, host in zip(valid_servers.domains, valid_servers.ip_addresses) if host in benchmark.coarse_results}
+                self.get_state_store().record_sync(end - start, num_servers, num_success, benchmark.complete, best_servers, probe_results)
 
                 if new_connections > 0:
                     self.logger.info("%i new connections added.", new_connections)
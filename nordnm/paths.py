@@ -7,13 +7,21 @@ USER_HOME = os.path.expanduser('~' + __username__)
 ROOT = os.path.join(USER_HOME, '.nordnm/')
 OVPN_CONFIGS = os.path.join(ROOT, 'configs/')
 CONFIG_INFO = os.path.join(OVPN_CONFIGS, '.info')
+CONFIG_MANIFEST = os.path.join(OVPN_CONFIGS, '.manifest')
+CONFIG_INDEX = os.path.join(OVPN_CONFIGS, '.index')
+OVPN_ARCHIVE = os.path.join(ROOT, '.ovpn.zip')
 SETTINGS = os.path.join(ROOT, 'settings.conf')
-ACTIVE_SERVERS = os.path.join(ROOT, '.active_servers')
+ACTIVE_SERVERS = os.path.join(ROOT, '.active_servers')  # Legacy, moved into STATE on first use
+STATE = os.path.join(ROOT, '.state.db')
+PROBE_CACHE = os.path.join(ROOT, '.probe_cache')
+SERVER_CACHE = os.path.join(ROOT, '.server_cache')
 CREDENTIALS = os.path.join(ROOT, 'credentials.conf')
+VERSION_CACHE = os.path.join(ROOT, '.version_cache')
 MAC_CONFIG = "/usr/lib/NetworkManager/conf.d/nordnm_mac.conf"
 AUTO_CONNECT_SCRIPT = "/etc/NetworkManager/dispatcher.d/nordnm_autoconnect_" + __username__
 KILLSWITCH_SCRIPT = "/etc/NetworkManager/dispatcher.d/nordnm_killswitch_" + __username__
 IPV6_SCRIPT = "/etc/NetworkManager/dispatcher.d/10_vpn_ipv6_" + __username__
+DAEMON_SOCKET = "/run/nordnm/daemon_" + __username__ + ".sock"  # In a directory only root can enter, since the daemon runs commands as root
 SYSTEM_CONNECTIONS = "/etc/NetworkManager/system-connections/"
 KILLSWITCH_DATA = os.path.join(ROOT, '.killswitch')
 
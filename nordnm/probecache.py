@@ -0,0 +1,109 @@
+from nordnm import scoring
+
+import logging
+import os
+import pickle
+import time
+
+
+class ProbeCache(object):
+    """
+    On-disk history of benchmark results, keyed by server IP address.
+    Each entry holds exponentially weighted benchmark metrics, used to predict how servers will do, and the last
+    measurement, which is reused as is for servers probed within the TTL so they don't need probing again.
+    """
+
+    EWMA_WEIGHT = 0.3  # Weight given to the newest result. The higher the number, the faster old results are forgotten
+    MAX_AGE = 30 * 24 * 60 * 60  # Entries of servers not probed for this many seconds (most likely retired) are dropped
+
+    def __init__(self, path, ttl):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as fp:
+                    self.entries = pickle.load(fp)
+                return True
+            except Exception as ex:
+                self.logger.error(ex)
+        return False
+
+    def prune(self):
+        oldest_time = time.time() - self.MAX_AGE
+        self.entries = {host: entry for host, entry in self.entries.items() if entry['time'] >= oldest_time}
+
+    def save(self):
+        self.prune()
+
+        try:
+            with open(self.path, 'wb') as fp:
+                pickle.dump(self.entries, fp)
+            return True
+        except Exception as ex:
+            self.logger.error(ex)
+            return False
+
+    def get_results(self, hosts, max_age=None):
+        # Returns {host: ProbeResult} for each host probed within max_age seconds (or ever, if None)
+        results = {}
+
+        now = time.time()
+        for host in hosts:
+            entry = self.entries.get(host)
+            if entry and (max_age is None or now - entry['time'] < max_age):
+                results[host] = scoring.ProbeResult(entry['rtt'], entry['loss'], entry['p95'], entry['jitter'])
+
+        return results
+
+    def get_fresh_results(self, hosts, min_attempts=1):
+        # Returns {host: ProbeResult} with the last measurement of each host probed within the TTL, if it was taken with at least min_attempts pings
+        if self.ttl <= 0:
+            return {}
+
+        results = {}
+
+        now = time.time()
+        for host in hosts:
+            entry = self.entries.get(host)
+            if entry and entry['last_attempts'] >= min_attempts and now - entry['time'] < self.ttl:
+                results[host] = scoring.ProbeResult(*entry['last'])
+
+        return results
+
+    def get_average(self, old_value, new_value):
+        if new_value is None:
+            return old_value
+        elif old_value is None:
+            return new_value
+
+        return self.EWMA_WEIGHT * new_value + (1 - self.EWMA_WEIGHT) * old_value
+
+    def update(self, probe_results, ping_attempts):
+        now = time.time()
+
+        for host, result in probe_results.items():
+            if result.rtt is None:
+                continue  # Not a single reply, so most likely a network problem rather than the server. Worth probing again next time
+
+            entry = self.entries.get(host)
+
+            if not entry:
+                self.entries[host] = {'rtt': result.rtt, 'loss': result.loss, 'p95': result.p95, 'jitter': result.jitter, 'samples': ping_attempts, 'time': now,
+                                      'last': tuple(result), 'last_attempts': ping_attempts}
+                continue
+
+            entry['rtt'] = self.get_average(entry['rtt'], result.rtt)
+            entry['p95'] = self.get_average(entry['p95'], result.p95)
+            entry['jitter'] = self.get_average(entry['jitter'], result.jitter)
+            entry['loss'] = self.get_average(entry['loss'], result.loss)
+            entry['samples'] += ping_attempts
+            entry['time'] = now
+            entry['last'] = tuple(result)
+            entry['last_attempts'] = ping_attempts
@@ -0,0 +1,82 @@
+from collections import namedtuple
+import math
+
+# numpy is only imported by the functions that need it, since the settings load this module for the weights alone
+
+# Benchmark result of a single host. All times are in milliseconds and loss is a percentage
+ProbeResult = namedtuple('ProbeResult', ['rtt', 'loss', 'p95', 'jitter'])
+FAILED_PROBE = ProbeResult(None, 100, None, None)
+
+# Weights of each benchmark metric in a server's score. With the defaults, score = exp(-((load / 100) * rtt) / 50)
+ScoreWeights = namedtuple('ScoreWeights', ['load', 'rtt', 'p95', 'jitter', 'loss', 'sensitivity', 'max_loss'])
+
+SCORE_DECIMALS = 4
+
+DEFAULT_WEIGHTS = ScoreWeights(
+    load=1.0,  # How much the server load scales the latency cost. 0 ignores load entirely
+    rtt=1.0,  # Cost per millisecond of mean round-trip time
+    p95=0.0,  # Cost per millisecond of 95th percentile round-trip time
+    jitter=0.0,  # Cost per millisecond of jitter (mean difference between consecutive round-trip times)
+    loss=0.0,  # Cost per percent of packet loss
+    sensitivity=50.0,  # Controls the gradient of the exponential score function. The higher the number, the smaller the gradient (change)
+    max_loss=5.0,  # Servers with this much packet loss (%) or more are considered unreliable and get the lowest score
+)
+
+
+def weigh_components(weights, loads, rtts, p95s, jitters, losses):
+    """
+    Returns the weighted terms of each server's cost, where:
+    cost = load_factor * (rtt + p95 + jitter) + loss
+    Works on single numbers and NumPy arrays alike, so servers scored one at a time and all at once score the same.
+    """
+
+    return {
+        'load_factor': (1 - weights.load) + weights.load * (loads / 100),
+        'rtt': weights.rtt * rtts,
+        'p95': weights.p95 * p95s,
+        'jitter': weights.jitter * jitters,
+        'loss': weights.loss * losses,
+    }
+
+
+def get_cost(components):
+    return components['load_factor'] * (components['rtt'] + components['p95'] + components['jitter']) + components['loss']
+
+
+def get_score_components(weights, loads, rtts, p95s, jitters, losses):
+    # The weighted terms of each server's cost as arrays
+    import numpy
+
+    # Results without percentile or jitter information are scored on their mean RTT alone
+    p95s = numpy.where(numpy.isnan(p95s), rtts, p95s)
+    jitters = numpy.where(numpy.isnan(jitters), 0, jitters)
+
+    return weigh_components(weights, loads, rtts, p95s, jitters, losses)
+
+
+def get_scores(weights, loads, rtts, p95s, jitters, losses, max_load=100):
+    # Score every server at once. Higher is better, with 1 being a perfect score and 0 the lowest
+    import numpy
+
+    cost = get_cost(get_score_components(weights, loads, rtts, p95s, jitters, losses))
+
+    with numpy.errstate(invalid='ignore'):
+        scores = numpy.round(numpy.exp(-cost / weights.sensitivity), SCORE_DECIMALS)
+
+        # Unreliable, overloaded or failed servers keep the lowest score
+        reliable = (loads < max_load) & (losses < weights.max_loss) & ~numpy.isnan(rtts)
+
+    return numpy.where(reliable, scores, 0)
+
+
+def get_score(weights, load, result, max_load=100):
+    # Score a single server, as get_scores() would. Cheaper than a call to get_scores() for results scored one at a time
+    if not result.rtt or load >= max_load or result.loss >= weights.max_loss:
+        return 0.0
+
+    p95 = result.rtt if result.p95 is None else result.p95
+    jitter = 0 if result.jitter is None else result.jitter
+
+    cost = get_cost(weigh_components(weights, load, result.rtt, p95, jitter, result.loss))
+
+    return round(math.exp(-cost / weights.sensitivity), SCORE_DECIMALS)
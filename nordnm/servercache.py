@@ -0,0 +1,131 @@
+from nordnm import nordapi
+
+import logging
+import os
+import pickle
+import time
+import zlib
+
+
+class ServerCache(object):
+    """
+    On-disk snapshot of the NordVPN /server catalog, stored compressed alongside its HTTP validators.
+    Snapshots younger than max_age are used without touching the network. Older ones are revalidated,
+    and are still used (with a warning) if the API can't be reached.
+    """
+
+    def __init__(self, path, max_age):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.max_age = max_age
+        self.snapshot = None  # {'data': zlib compressed JSON, 'etag': ..., 'last_modified': ..., 'time': ...}
+        self.snapshot_list = None  # The snapshot once parsed, so a long-lived cache (such as the daemon's) only parses each snapshot once
+
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as fp:
+                    self.snapshot = pickle.load(fp)
+                self.snapshot_list = None
+                return True
+            except Exception as ex:
+                self.logger.error(ex)
+        return False
+
+    def save(self):
+        # Nothing to save to yet, such as when listing countries before the first sync
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return False
+
+        # Written beside the old cache and swapped in, so another nordnm process (such as the daemon's) never reads it half written
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as fp:
+                pickle.dump(self.snapshot, fp)
+
+            os.replace(temp_path, self.path)
+            return True
+        except Exception as ex:
+            self.logger.error(ex)
+            return False
+
+    def get_age(self):
+        if not self.snapshot:
+            return None
+
+        return time.time() - self.snapshot['time']
+
+    def iter_snapshot_chunks(self):
+        decompressor = zlib.decompressobj()
+        data = self.snapshot['data']
+
+        for i in range(0, len(data), nordapi.CHUNK_SIZE):
+            yield decompressor.decompress(data[i:i + nordapi.CHUNK_SIZE])
+
+        yield decompressor.flush()
+
+    def get_snapshot_list(self):
+        if self.snapshot_list is None:
+            try:
+                self.snapshot_list = list(nordapi.iter_servers(self.iter_snapshot_chunks()))
+            except (zlib.error, ValueError) as ex:
+                self.logger.error("Could not read the cached server list: %s", ex)
+                self.snapshot = None
+                return None
+
+        return list(self.snapshot_list)
+
+    def get_server_list(self):
+        age = self.get_age()
+        if age is not None and 0 <= age < self.max_age:
+            return self.get_snapshot_list()
+
+        etag = None
+        last_modified = None
+        if self.snapshot:
+            etag = self.snapshot['etag']
+            last_modified = self.snapshot['last_modified']
+
+        server_data = nordapi.get_server_data(etag, last_modified)
+
+        server_list = None
+        if server_data:
+            chunks, etag, last_modified = server_data
+            if chunks is None:
+                # Not modified, so the snapshot is good for another max_age
+                self.snapshot['time'] = time.time()
+                self.save()
+                return self.get_snapshot_list()
+
+            # Compress the response as it streams in, rather than keeping a copy of the whole body
+            compressor = zlib.compressobj()
+            compressed_chunks = []
+
+            def compress(chunks):
+                for chunk in chunks:
+                    compressed_chunks.append(compressor.compress(chunk))
+                    yield chunk
+
+            try:
+                server_list = list(nordapi.iter_servers(compress(chunks)))
+            except ValueError as ex:
+                self.logger.error("Could not parse the server list from the NordVPN API: %s", ex)
+            except Exception as ex:
+                self.logger.error("Could not download the server list from the NordVPN API: %s", ex)
+
+        if server_list is None:
+            if self.snapshot:
+                self.logger.warning("Could not get the latest server list from the NordVPN API. Using the cached list from %i minutes ago.", age // 60)
+                return self.get_snapshot_list()
+
+            return None
+
+        compressed_chunks.append(compressor.flush())
+        self.snapshot = {'data': b''.join(compressed_chunks), 'etag': etag, 'last_modified': last_modified, 'time': time.time()}
+        self.snapshot_list = server_list
+        self.save()
+
+        return server_list
@@ -0,0 +1,166 @@
+from nordnm import nordapi
+
+import numpy
+
+# Protocol support is stored as bit flags, and category membership as a bitmask with one bit per known category
+PROTOCOL_FLAGS = {'udp': 1, 'tcp': 2}
+CATEGORY_BITS = {name: 1 << bit for bit, name in enumerate(sorted(nordapi.VPN_CATEGORIES))}
+
+
+def get_category_label(category_names):
+    # The short names of a server's categories, as used in its connection name e.g. 'normal|p2p'
+    return '|'.join(nordapi.VPN_CATEGORIES.get(name, name) for name in category_names)
+
+
+def get_protocol_flags(protocols):
+    flags = 0
+    for protocol in protocols:
+        flags |= PROTOCOL_FLAGS.get(protocol, 0)
+
+    return flags
+
+
+def get_category_mask(category_names):
+    mask = 0
+    for name in category_names:
+        mask |= CATEGORY_BITS.get(name, 0)
+
+    return mask
+
+
+class ServerCatalog(object):
+    """
+    Servers held column by column, rather than as one record per server.
+    Countries and category combinations are interned, so each server only stores small integer ids into
+    the shared tables, along with a category bitmask and protocol flags that queries can test all at once.
+    """
+
+    def __init__(self, servers=()):
+        self.countries = []  # Lowercase country codes, indexed by country id
+        self.country_names = []
+        self.category_sets = []  # Tuples of long category names (in API order), indexed by category set id
+        self.category_labels = []
+        self.category_set_masks = []
+
+        country_ids = {}
+        category_set_ids = {}
+
+        self.domains = []
+        self.ip_addresses = []
+        loads = []
+        server_country_ids = []
+        server_category_set_ids = []
+        protocols = []
+
+        for server in servers:
+            country_code = server.flag.lower()
+            if country_code not in country_ids:
+                country_ids[country_code] = len(self.countries)
+                self.countries.append(country_code)
+                self.country_names.append(server.country)
+
+            if server.categories not in category_set_ids:
+                category_set_ids[server.categories] = len(self.category_sets)
+                self.category_sets.append(server.categories)
+                self.category_labels.append(get_category_label(server.categories))
+                self.category_set_masks.append(get_category_mask(server.categories))
+
+            self.domains.append(server.domain)
+            self.ip_addresses.append(server.ip_address)
+            loads.append(server.load)
+            server_country_ids.append(country_ids[country_code])
+            server_category_set_ids.append(category_set_ids[server.categories])
+            protocols.append((PROTOCOL_FLAGS['udp'] if server.openvpn_udp else 0) | (PROTOCOL_FLAGS['tcp'] if server.openvpn_tcp else 0))
+
+        self.loads = numpy.array(loads, dtype=numpy.int32)
+        self.country_ids = numpy.array(server_country_ids, dtype=numpy.int32)
+        self.category_set_ids = numpy.array(server_category_set_ids, dtype=numpy.int32)
+        self.protocols = numpy.array(protocols, dtype=numpy.uint8)
+        self.category_set_masks = numpy.array(self.category_set_masks, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.domains)
+
+    @property
+    def category_masks(self):
+        return self.category_set_masks[self.category_set_ids]
+
+    def subset(self, indexes):
+        # A catalog of only the servers at indexes (in that order), sharing this catalog's interned tables
+        catalog = ServerCatalog()
+        catalog.countries = self.countries
+        catalog.country_names = self.country_names
+        catalog.category_sets = self.category_sets
+        catalog.category_labels = self.category_labels
+        catalog.category_set_masks = self.category_set_masks
+
+        catalog.domains = [self.domains[index] for index in indexes]
+        catalog.ip_addresses = [self.ip_addresses[index] for index in indexes]
+        catalog.loads = self.loads[indexes]
+        catalog.country_ids = self.country_ids[indexes]
+        catalog.category_set_ids = self.category_set_ids[indexes]
+        catalog.protocols = self.protocols[indexes]
+
+        return catalog
+
+    def get_bucket_members(self, valid_protocols, valid_categories):
+        # Flatten bucket membership into parallel arrays of (bucket id, server index), with bucket_keys mapping ids back to (country, category, protocol) keys
+        bucket_keys = []
+        member_buckets = []
+        member_servers = []
+
+        category_masks = self.category_masks
+        for category in valid_categories:
+            category_in = (category_masks & get_category_mask([category])) != 0
+
+            for protocol in ('udp', 'tcp'):
+                if protocol not in valid_protocols:
+                    continue
+
+                servers = numpy.flatnonzero(category_in & ((self.protocols & PROTOCOL_FLAGS[protocol]) != 0))
+                country_ids, buckets = numpy.unique(self.country_ids[servers], return_inverse=True)
+
+                member_buckets.append(len(bucket_keys) + buckets)
+                member_servers.append(servers)
+                bucket_keys.extend((self.countries[country_id], nordapi.VPN_CATEGORIES[category], protocol) for country_id in country_ids)
+
+        if not member_buckets:
+            return (bucket_keys, numpy.array([], dtype=int), numpy.array([], dtype=int))
+
+        return (bucket_keys, numpy.concatenate(member_buckets), numpy.concatenate(member_servers))
+
+    def get_connection_name(self, index, protocol):
+        short_name = self.domains[index].split('.')[0]
+        return short_name + ' [' + self.category_labels[self.category_set_ids[index]] + '] [' + protocol + ']'
+
+
+class ServerFilter(object):
+    """
+    The server selection settings, compiled once into a set of selected countries, protocol flags and a category bitmask.
+    Servers are kept if their country is selected, and they support any valid protocol and are in any valid category.
+    """
+
+    def __init__(self, valid_protocols, valid_categories, white_list=None, black_list=None):
+        self.white_list = set(white_list) if white_list else None
+        self.black_list = set(black_list) if black_list else None
+        self.protocol_flags = get_protocol_flags(valid_protocols)
+        self.category_mask = get_category_mask(valid_categories)
+
+    def country_is_selected(self, country_code):
+        # A whitelist takes precedence over a blacklist. With neither, every country is selected
+        if self.white_list:
+            return country_code in self.white_list
+        elif self.black_list:
+            return country_code not in self.black_list
+        else:
+            return True
+
+    def select(self, catalog):
+        # Returns the indexes of the servers in catalog that pass the filter, testing whole columns at once
+        selected_countries = numpy.array([self.country_is_selected(country_code) for country_code in catalog.countries], dtype=bool)
+
+        selected = selected_countries[catalog.country_ids]
+        selected &= (catalog.protocols & self.protocol_flags) != 0
+        selected &= (catalog.category_masks & self.category_mask) != 0
+
+        return numpy.flatnonzero(selected)
@@ -1,5 +1,7 @@
 from nordnm import utils
 from nordnm import nordapi
+from nordnm import httpclient
+from nordnm import scoring
 
 import configparser
 import logging
@@ -10,6 +12,13 @@ import sys
 
 class SettingsHandler(object):
     DEFAULT_PING_ATTEMPTS = 5
+    DEFAULT_REFINE_CANDIDATES = 3
+    DEFAULT_CACHE_TTL = 300
+    DEFAULT_PROBE_RATE = 2000
+    DEFAULT_PROBE_BURST = 100
+    DEFAULT_LOSS_THRESHOLD = 10.0
+    DEFAULT_SERVER_LIST_MAX_AGE = 300
+    SCORING_OPTIONS = ['load-weight', 'rtt-weight', 'p95-weight', 'jitter-weight', 'loss-weight', 'sensitivity', 'max-loss']  # In the order of scoring.ScoreWeights
 
     def __init__(self, path):
         self.logger = logging.getLogger(__name__)
@@ -82,6 +91,61 @@ class SettingsHandler(object):
         if not ping_attempts:
             ping_attempts = str(self.DEFAULT_PING_ATTEMPTS)
         self.settings.set('Benchmarking', 'ping-attempts', ping_attempts)
+        self.settings.set(
+            'Benchmarking',
+            '\n# servers are first swept with a single ping. This many of the best servers for each country, category and protocol are then re-tested with all ping attempts (0 tests every server fully)'
+        )
+        self.settings.set('Benchmarking', 'refine-candidates',
+                          str(self.DEFAULT_REFINE_CANDIDATES))
+        self.settings.set(
+            'Benchmarking',
+            '\n# servers benchmarked less than this many seconds ago are not benchmarked again (0 disables the cache)'
+        )
+        self.settings.set('Benchmarking', 'cache-ttl',
+                          str(self.DEFAULT_CACHE_TTL))
+        self.settings.set(
+            'Benchmarking',
+            '\n# maximum pings sent per second, and how many may be sent at once. Lower these if your network or firewall limits ICMP traffic'
+        )
+        self.settings.set('Benchmarking', 'probe-rate',
+                          str(self.DEFAULT_PROBE_RATE))
+        self.settings.set('Benchmarking', 'probe-burst',
+                          str(self.DEFAULT_PROBE_BURST))
+        self.settings.set(
+            'Benchmarking',
+            '\n# when more than this percentage of recent pings are lost, the ping rate is halved until the losses stop'
+        )
+        self.settings.set('Benchmarking', 'loss-threshold',
+                          str(self.DEFAULT_LOSS_THRESHOLD))
+
+        self.settings.add_section('Scoring')
+        self.settings.set(
+            'Scoring',
+            '# how much each benchmark metric costs a server. score = exp(-(load factor * (rtt + p95 + jitter) + loss) / sensitivity)'
+        )
+        for option, value in zip(self.SCORING_OPTIONS, scoring.DEFAULT_WEIGHTS):
+            self.settings.set('Scoring', option, str(value))
+
+        self.settings.add_section('API')
+        self.settings.set(
+            'API',
+            '# the server list is only downloaded again once it is older than this many seconds (0 always checks for a new list)'
+        )
+        self.settings.set('API', 'server-list-max-age',
+                          str(self.DEFAULT_SERVER_LIST_MAX_AGE))
+        self.settings.set(
+            'API',
+            '\n# seconds to wait for a connection, and then between bytes of a response, before a request fails'
+        )
+        self.settings.set('API', 'connect-timeout',
+                          str(httpclient.CONNECT_TIMEOUT))
+        self.settings.set('API', 'read-timeout',
+                          str(httpclient.READ_TIMEOUT))
+        self.settings.set(
+            'API',
+            '\n# how many more times to try a failed download, waiting a little longer each time'
+        )
+        self.settings.set('API', 'retries', str(httpclient.RETRIES))
 
         self.save()  # And save it
 
@@ -166,6 +230,89 @@ class SettingsHandler(object):
             )  # Lets set the default, so we only get this warning once
             return self.DEFAULT_PING_ATTEMPTS
 
+    def get_benchmarking_option(self, option, default, cast=int, minimum=0):
+        return self.get_numeric_option('Benchmarking', option, default, cast,
+                                       minimum)
+
+    def get_numeric_option(self, section, option, default, cast=int, minimum=0):
+        # Optional settings fall back to their default when missing, so older settings files keep working
+        try:
+            value = cast(self.settings.get(section, option))
+            if value >= minimum:
+                return value
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            return default
+        except ValueError:
+            pass
+
+        self.logger.warning("Invalid %s value. Using default value of %s.",
+                            option, default)
+        self.settings.set(section, option, str(
+            default))  # Lets set the default, so we only get this warning once
+        return default
+
+    def get_refine_candidates(self):
+        return self.get_benchmarking_option('refine-candidates',
+                                            self.DEFAULT_REFINE_CANDIDATES)
+
+    def get_cache_ttl(self):
+        return self.get_benchmarking_option('cache-ttl',
+                                            self.DEFAULT_CACHE_TTL)
+
+    def get_probe_rate(self):
+        return self.get_benchmarking_option('probe-rate',
+                                            self.DEFAULT_PROBE_RATE,
+                                            minimum=1)
+
+    def get_probe_burst(self):
+        return self.get_benchmarking_option('probe-burst',
+                                            self.DEFAULT_PROBE_BURST,
+                                            minimum=1)
+
+    def get_loss_threshold(self):
+        return self.get_benchmarking_option('loss-threshold',
+                                            self.DEFAULT_LOSS_THRESHOLD,
+                                            cast=float)
+
+    def get_server_list_max_age(self):
+        return self.get_numeric_option('API', 'server-list-max-age',
+                                       self.DEFAULT_SERVER_LIST_MAX_AGE)
+
+    def get_connect_timeout(self):
+        return self.get_numeric_option('API', 'connect-timeout',
+                                       httpclient.CONNECT_TIMEOUT,
+                                       cast=float,
+                                       minimum=0.1)
+
+    def get_read_timeout(self):
+        return self.get_numeric_option('API', 'read-timeout',
+                                       httpclient.READ_TIMEOUT,
+                                       cast=float,
+                                       minimum=0.1)
+
+    def get_retries(self):
+        return self.get_numeric_option('API', 'retries', httpclient.RETRIES)
+
+    def get_score_weights(self):
+        weights = []
+
+        for option, default in zip(self.SCORING_OPTIONS, scoring.DEFAULT_WEIGHTS):
+            try:
+                weight = float(self.settings.get('Scoring', option))
+                if weight >= 0 and not (option == 'sensitivity' and weight == 0):
+                    weights.append(weight)
+                    continue
+
+                self.logger.warning("Invalid %s value. Using default value of %s.", option, default)
+            except (configparser.NoSectionError, configparser.NoOptionError):
+                pass
+            except ValueError:
+                self.logger.warning("Invalid %s value. Using default value of %s.", option, default)
+
+            weights.append(default)
+
+        return scoring.ScoreWeights(*weights)
+
     def get_custom_dns_servers(self) -> list:
         try:
             custom_dns_list = self.settings.get(
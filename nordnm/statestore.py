@@ -0,0 +1,203 @@
+import logging
+import os
+import pickle
+import sqlite3
+import time
+
+MAX_SYNCS = 1000  # Syncs (and their winners) kept in the history
+MAX_SAMPLE_SYNCS = 50  # Syncs whose probe results are kept. Each one holds a row per benchmarked server
+
+# Each entry upgrades the schema by one version. The version of a database is kept in its user_version
+MIGRATIONS = [
+    '''
+    CREATE TABLE active_servers (
+        country TEXT NOT NULL,
+        category TEXT NOT NULL,
+        protocol TEXT NOT NULL,
+        name TEXT NOT NULL,
+        domain TEXT NOT NULL,
+        info BLOB NOT NULL,
+        PRIMARY KEY (country, category, protocol)
+    );
+    CREATE INDEX active_servers_domain ON active_servers (domain);
+
+    CREATE TABLE syncs (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        duration REAL NOT NULL,
+        num_servers INTEGER NOT NULL,
+        num_success INTEGER NOT NULL,
+        complete INTEGER NOT NULL
+    );
+
+    CREATE TABLE sync_winners (
+        sync_id INTEGER NOT NULL,
+        country TEXT NOT NULL,
+        category TEXT NOT NULL,
+        protocol TEXT NOT NULL,
+        domain TEXT NOT NULL,
+        score REAL,
+        load INTEGER,
+        latency REAL
+    );
+    CREATE INDEX sync_winners_sync ON sync_winners (sync_id);
+    CREATE INDEX sync_winners_bucket ON sync_winners (country, category, protocol, sync_id);
+    CREATE INDEX sync_winners_domain ON sync_winners (domain, sync_id);
+
+    CREATE TABLE probe_samples (
+        sync_id INTEGER NOT NULL,
+        domain TEXT NOT NULL,
+        rtt REAL,
+        loss REAL,
+        p95 REAL,
+        jitter REAL
+    );
+    CREATE INDEX probe_samples_sync ON probe_samples (sync_id);
+    CREATE INDEX probe_samples_domain ON probe_samples (domain, sync_id);
+    ''',
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+logger = logging.getLogger(__name__)
+
+
+def load_legacy_active_servers(path):
+    # Earlier versions kept the active servers in a pickle
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as ex:
+        logger.error("Could not load the active servers: %s", ex)
+        return {}
+
+
+class StateStore(object):
+    """
+    Local state kept in a SQLite database: the active servers, and a history of syncs with the winner of every
+    bucket and the probe results of recent syncs. Every change is committed straight away.
+    """
+
+    def __init__(self, path, legacy_path=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.legacy_path = legacy_path  # The active servers pickle used by earlier versions, imported on first use
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')  # Safe with WAL. Only a power cut can lose the last commits, never corrupt the database
+
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version > SCHEMA_VERSION:
+                connection.close()
+                raise sqlite3.DatabaseError("'%s' was created by a newer version of nordnm (schema %i)" % (self.path, version))
+
+            for migration in MIGRATIONS[version:]:
+                version += 1
+                connection.executescript('BEGIN; %s; PRAGMA user_version = %i; COMMIT;' % (migration, version))
+
+            self.connection = connection
+            self.import_legacy_active_servers()
+
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def import_legacy_active_servers(self):
+        if not self.legacy_path:
+            return
+
+        if not os.path.isfile(self.legacy_path):
+            return
+
+        active_servers = load_legacy_active_servers(self.legacy_path)
+        with self.connection:
+            for key, server in active_servers.items():
+                self.write_active_server(key, server)
+
+        os.remove(self.legacy_path)
+
+        self.logger.debug("Moved %i active servers from '%s' to '%s'.", len(active_servers), self.legacy_path, self.path)
+
+    def exists(self):
+        if os.path.isfile(self.path):
+            return True
+
+        return bool(self.legacy_path) and os.path.isfile(self.legacy_path)
+
+    def load(self):
+        # Returns the active servers as {(country, category, protocol): server info}
+        if self.connection is None and not self.exists():
+            return {}  # Don't create a database just to find it empty
+
+        try:
+            rows = self.connect().execute('SELECT country, category, protocol, info FROM active_servers')
+            return {(country, category, protocol): pickle.loads(info) for country, category, protocol, info in rows}
+        except Exception as ex:
+            self.logger.error("Could not load the active servers: %s", ex)
+            return {}
+
+    def write_active_server(self, key, server):
+        self.connection.execute('INSERT OR REPLACE INTO active_servers VALUES (?, ?, ?, ?, ?, ?)',
+                                key + (server['name'], server['domain'], pickle.dumps(server)))
+
+    def set(self, key, server):
+        try:
+            with self.connect():
+                self.write_active_server(key, server)
+
+            return True
+        except Exception as ex:
+            self.logger.error("Could not save the active servers: %s", ex)
+            return False
+
+    def remove(self, key):
+        try:
+            with self.connect() as connection:
+                connection.execute('DELETE FROM active_servers WHERE country = ? AND category = ? AND protocol = ?', key)
+
+            return True
+        except Exception as ex:
+            self.logger.error("Could not save the active servers: %s", ex)
+            return False
+
+    def record_sync(self, duration, num_servers, num_success, complete, best_servers, probe_results):
+        """
+        Adds a sync to the history, with its best servers and the probe results {domain: scoring.ProbeResult} it gathered.
+        The oldest syncs are dropped once there are more than MAX_SYNCS, and their probe results after MAX_SAMPLE_SYNCS.
+        """
+
+        try:
+            with self.connect() as connection:
+                sync_id = connection.execute('INSERT INTO syncs (time, duration, num_servers, num_success, complete) VALUES (?, ?, ?, ?, ?)',
+                                             (time.time(), duration, num_servers, num_success, int(complete))).lastrowid
+
+                connection.executemany('INSERT INTO sync_winners VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                       ((sync_id,) + key + (server['domain'], float(server['score']), int(server['load']), float(server['latency'])) for key, server in best_servers.items()))
+                connection.executemany('INSERT INTO probe_samples VALUES (?, ?, ?, ?, ?, ?)',
+                                       ((sync_id, domain) + tuple(None if value is None else float(value) for value in result) for domain, result in probe_results.items()))
+
+                connection.execute('DELETE FROM sync_winners WHERE sync_id <= ?', (sync_id - MAX_SYNCS,))
+                connection.execute('DELETE FROM syncs WHERE id <= ?', (sync_id - MAX_SYNCS,))
+                connection.execute('DELETE FROM probe_samples WHERE sync_id <= ?', (sync_id - MAX_SAMPLE_SYNCS,))
+
+            return sync_id
+        except Exception as ex:
+            self.logger.error("Could not save the sync history: %s", ex)
+            return None
+
+    def get_sync_history(self, limit=20):
+        # The most recent syncs first, as (sync id, time, duration, servers, successes, complete, buckets) rows
+        if self.connection is None and not os.path.isfile(self.path):
+            return []
+
+        return self.connect().execute('''
+            SELECT id, time, duration, num_servers, num_success, complete, (SELECT COUNT(*) FROM sync_winners WHERE sync_id = id)
+            FROM syncs ORDER BY id DESC LIMIT ?''', (limit,)).fetchall()
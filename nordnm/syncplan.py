@@ -0,0 +1,51 @@
+from collections import namedtuple
+
+# The bucket keys (country, category, protocol) whose connections are kept as they are, added, replaced with a new server or removed
+SyncPlan = namedtuple('SyncPlan', ['keep', 'add', 'update', 'remove'])
+
+
+def get_sync_plan(active_servers, best_servers, changed_domains=(), unfinished_buckets=()):
+    """
+    Works out the changes needed to go from the active servers to the best servers, bucket by bucket.
+    A bucket whose best server is unchanged is kept, unless the server's config has changed since it was imported.
+    Buckets in unfinished_buckets (not fully benchmarked) that found no best server keep their active server, rather than being removed.
+    """
+
+    keep = []
+    add = []
+    update = []
+    remove = []
+
+    for key, server in best_servers.items():
+        active_server = active_servers.get(key)
+        if active_server is None:
+            add.append(key)
+        elif active_server['name'] == server['name'] and server['domain'] not in changed_domains:
+            keep.append(key)
+        else:
+            update.append(key)
+
+    for key in active_servers:
+        if key not in best_servers:
+            if key in unfinished_buckets:
+                keep.append(key)
+            else:
+                remove.append(key)
+
+    return SyncPlan(keep, add, update, remove)
+
+
+def get_obsolete_connections(active_servers, best_servers, plan):
+    """
+    Returns the names of the connections to delete to carry out plan: those no bucket will use any more, and those to import again from a changed config.
+    Servers in more than one category share a connection between buckets, so a connection is only deleted once no bucket still uses it.
+    """
+
+    target_servers = {key: active_servers[key] for key in plan.keep if key not in best_servers}
+    target_servers.update(best_servers)
+    target_names = set(server['name'] for server in target_servers.values())
+
+    old_names = set(active_servers[key]['name'] for key in plan.update + plan.remove)
+    new_names = set(best_servers[key]['name'] for key in plan.update)
+
+    return (old_names - target_names) | (old_names & new_names)
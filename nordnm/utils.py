@@ -1,11 +1,15 @@
+from nordnm import httpclient
+
 import os
 import stat
-from io import BytesIO
-from zipfile import ZipFile
 import subprocess
 import logging
 import getpass
-import requests
+import pickle
+import time
+
+VERSION_CHECK_TTL = 24 * 60 * 60  # Seconds before the latest version on PyPI is checked again
+VERSION_CHECK_TIMEOUT = 1  # Seconds to wait for PyPI to connect, and then to respond. The check is skipped if it's slower
 
 logger = logging.getLogger(__name__)
 
@@ -37,22 +41,59 @@ class LoggingFormatter(logging.Formatter):
 
 def get_pypi_package_version(package_name):
     try:
-        resp = requests.get("https://pypi.python.org/pypi/" + package_name +
-                            "/json",
-                            timeout=0.1)
+        resp = httpclient.request('GET', "https://pypi.python.org/pypi/" +
+                                  package_name + "/json",
+                                  timeout=VERSION_CHECK_TIMEOUT, retries=0)
 
-        if resp.status_code == requests.codes.ok:
+        if resp.status_code == 200:
             package = resp.json()
 
             if 'version' in package['info']:
                 return package['info']['version']
 
     except Exception:
-        logger.warning("Could not check for latest version.")
+        logger.debug("Could not check for latest version.")
 
     return False
 
 
+def load_version_cache(cache_path):
+    # Returns (latest version, time of the check), or (None, 0) if it was never checked
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return (None, 0)
+
+
+def get_latest_version(cache_path):
+    # Returns the latest version on PyPI as of the last check (or None), without waiting on the network
+    return load_version_cache(cache_path)[0]
+
+
+def update_version_cache(package_name, cache_path, ttl=VERSION_CHECK_TTL):
+    """
+    Checks PyPI for the latest version of package_name, if the last check is more than ttl seconds old.
+    Only called by commands that take a while anyway, such as sync, so quick ones never wait on the network.
+    Failed checks are recorded too, so an unreachable PyPI only slows down one sync per ttl.
+    """
+
+    cached_version, checked = load_version_cache(cache_path)
+    if time.time() - checked <= ttl:
+        return False
+
+    latest_version = get_pypi_package_version(package_name) or cached_version
+
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump((latest_version, time.time()), f)
+
+        return True
+    except Exception as ex:
+        logger.debug("Could not save the latest version: %s", ex)
+        return False
+
+
 # Yes/No question, defaults to yes
 def input_yes_no(question):
     yes = set(['yes', 'y', ''])
@@ -69,10 +110,13 @@ def input_yes_no(question):
 # Returns the process back to root user to run a given function, then back to normal user
 def run_as_root(method):
     os.seteuid(0)  # Be root
-    result = method()
-    os.seteuid(int(os.getenv("SUDO_UID")))
-
-    return result
+    try:
+        return method()
+    finally:
+        # Back to the original user, if there is one, even if method raised
+        user_uid = os.getenv("SUDO_UID")
+        if user_uid:
+            os.seteuid(int(user_uid))
 
 
 # Since we're running with root priveledges, this will return the current username
@@ -88,18 +132,6 @@ def format_std_string(input_string):
     return input_string.decode('utf-8').replace('\n', ' ')
 
 
-def extract_zip(input_stream, output_path):
-    try:
-        zipfile = ZipFile(BytesIO(input_stream))
-        zipfile.extractall(output_path)
-
-        return True
-
-    except Exception as ex:
-        logger.error(ex)
-        return False
-
-
 def make_executable(file_path):
     try:
         if os.path.isfile(file_path):
@@ -112,7 +144,7 @@ def make_executable(file_path):
         return False
 
 
-def get_rtt_loss(host, ping_attempts):
+def get_rtt_stats(host, ping_attempts):
     try:
         ping_env = os.environ.copy()
         ping_env["LANG"] = "C"
@@ -133,8 +165,11 @@ def get_rtt_loss(host, ping_attempts):
         packets_recieved = int(split_info[3])
         if packets_recieved > 0:
             loss = float(split_info[5].split('%')[0])
-            avg_rtt = float(split_rtt[3].split('/')[1])
-            return (avg_rtt, loss)
+            rtt_stats = split_rtt[3].split('/')  # min/avg/max/mdev
+            avg_rtt = float(rtt_stats[1])
+            max_rtt = float(rtt_stats[2])
+            mdev_rtt = float(rtt_stats[3])
+            return (avg_rtt, loss, max_rtt, mdev_rtt)
 
     except IndexError as ex:
         logger.error("Could not interpret output of ping command.\nOutput: %s",
@@ -148,4 +183,4 @@ def get_rtt_loss(host, ping_attempts):
         #    out = format_std_string(output.stdout)
         #    logger.warning("Ping failed with output: %s", out)
 
-    return (None, 100)  # If anything failed, return rtt as None and 100% loss
+    return (None, 100, None, None)  # If anything failed, return rtt as None and 100% loss